@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+# encoding: utf-8
+
+
+import os
+import sys
+sys.path.append('libs/')
+import json
+import shutil
+import platform
+import itertools
+import subprocess
+import tempfile
+import numpy as np
+import cv2
+from timeit import default_timer as timer
+from argparse import ArgumentParser
+from PIL import Image
+from tensorflow.keras.utils import OrderedEnqueuer
+from util import DataLoader
+
+
+# Sample call
+"""
+# Sweep the image mode and compare with a previous run
+python3 benchmark_loader.py --media_types i --batch_sizes 16 32 --workers 1 4 8 --output bench_loader.json
+"""
+
+def parse_args():
+    parser = ArgumentParser(description='Throughput benchmark of the SRGAN DataLoader on synthetic data')
+
+    parser.add_argument('-mt', '--media_types', type=str, nargs='+', default=['i', 'v'], help='Media types to benchmark')
+    parser.add_argument('-bs', '--batch_sizes', type=int, nargs='+', default=[16], help='Batch sizes to sweep')
+    parser.add_argument('-cpi', '--crops_per_image', type=int, nargs='+', default=[1, 4], help='Crops per image to sweep')
+    parser.add_argument('-w', '--workers', type=int, nargs='+', default=[0, 4], help='Enqueuer workers to sweep, 0 to load in this process')
+    parser.add_argument('-cs', '--colorspaces', type=str, nargs='+', default=['RGB'], help='Colorspaces to sweep')
+    parser.add_argument('-c', '--channels', type=int, nargs='+', default=[3], help='Channels to sweep')
+    parser.add_argument('-sc', '--scale', type=int, default=2, help='Upscaling factor')
+    parser.add_argument('-hr', '--hr_size', type=int, default=96, help='Size of the HR crops')
+    parser.add_argument('-nb', '--batches', type=int, default=50, help='Timed batches per configuration')
+    parser.add_argument('-wu', '--warmup', type=int, default=5, help='Untimed batches per configuration')
+    parser.add_argument('-ni', '--images', type=int, default=64, help='Synthetic images to generate')
+    parser.add_argument('-nv', '--videos', type=int, default=32, help='Synthetic videos to generate, at least the batch size (one video per batch item)')
+    parser.add_argument('-is', '--image_size', type=int, nargs=2, default=[512, 384], help='Width and height of the synthetic media')
+    parser.add_argument('-vf', '--video_frames', type=int, default=60, help='Frames of each synthetic video')
+    parser.add_argument('-d', '--datapath', type=str, default=None, help='Where to generate the synthetic data (temporary folder if not set)')
+    parser.add_argument('-o', '--output', type=str, default=None, help='JSON file with the results (stdout if not set)')
+
+    return parser.parse_args()
+
+def synthetic_frame(width, height, rng):
+    """Smooth gradients plus noise, so that JPEG / video encoding does real work"""
+    x = np.linspace(0, 255, width)[None, :, None]
+    y = np.linspace(0, 255, height)[:, None, None]
+    phase = rng.uniform(0, 255, 3)[None, None, :]
+    img = (x + y + phase) % 256 + rng.normal(0, 20, (height, width, 3))
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+def generate_images(path, n, width, height, seed=0):
+    rng = np.random.RandomState(seed)
+    os.makedirs(path)
+    for i in range(n):
+        ext = 'png' if i % 4 == 0 else 'jpg'
+        Image.fromarray(synthetic_frame(width, height, rng)).save(os.path.join(path, 'img_{:05d}.{}'.format(i, ext)))
+
+def generate_videos(path, n, width, height, frames, seed=0):
+    rng = np.random.RandomState(seed)
+    os.makedirs(path)
+    for i in range(n):
+        writer = cv2.VideoWriter(os.path.join(path, 'video_{:03d}.mp4'.format(i)), cv2.VideoWriter_fourcc(*'mp4v'), 30, (width, height))
+        base = synthetic_frame(width, height, rng)
+        for f in range(frames):
+            writer.write(np.roll(base, 2 * f, axis=1))
+        writer.release()
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(loader, workers, batches, warmup):
+    """Time batches drawn from the loader, in this process or through an OrderedEnqueuer"""
+    # An empty loader would divide by zero, or leave the enqueuer waiting forever
+    if len(loader) == 0:
+        raise ValueError('The loader has no batch: {} items for batches of {}. Generate more images / videos or use a smaller batch size'.format(
+            loader.total_imgs, loader.batch_size))
+    enqueuer = None
+    if workers:
+        enqueuer = OrderedEnqueuer(loader, use_multiprocessing=True, shuffle=True)
+        enqueuer.start(workers=workers, max_queue_size=10)
+        output_generator = enqueuer.get()
+    else:
+        output_generator = (loader[i % len(loader)] for i in itertools.count())
+
+    latencies = []
+    try:
+        for i in range(warmup + batches):
+            start = timer()
+            next(output_generator)
+            if i >= warmup:
+                latencies.append(timer() - start)
+    finally:
+        if enqueuer is not None:
+            enqueuer.stop()
+
+    latencies = np.array(latencies)
+    return {
+        'batches_per_sec': float(len(latencies) / latencies.sum()),
+        'latency_ms': {
+            'mean': float(latencies.mean() * 1000),
+            'p50': float(np.percentile(latencies, 50) * 1000),
+            'p90': float(np.percentile(latencies, 90) * 1000),
+            'p99': float(np.percentile(latencies, 99) * 1000)
+        }
+    }
+
+# Run script
+if __name__ == '__main__':
+
+    # Parse command-line arguments
+    args = parse_args()
+
+    datapath = args.datapath or tempfile.mkdtemp(prefix='srgan_bench_')
+    width, height = args.image_size
+    paths = {'i': os.path.join(datapath, 'images'), 'v': os.path.join(datapath, 'videos')}
+    if 'i' in args.media_types and not os.path.isdir(paths['i']):
+        print(">> Generating {} synthetic images".format(args.images))
+        generate_images(paths['i'], args.images, width, height)
+    if 'v' in args.media_types and not os.path.isdir(paths['v']):
+        print(">> Generating {} synthetic videos".format(args.videos))
+        generate_videos(paths['v'], args.videos, width, height, args.video_frames)
+
+    results = []
+    try:
+        for media_type, batch_size, crops_per_image, workers, colorspace, channels in itertools.product(
+                args.media_types, args.batch_sizes, args.crops_per_image, args.workers, args.colorspaces, args.channels):
+            config = {
+                'media_type': media_type,
+                'batch_size': batch_size,
+                'crops_per_image': crops_per_image,
+                'workers': workers,
+                'colorspace': colorspace,
+                'channels': channels
+            }
+            loader = DataLoader(
+                paths[media_type], batch_size,
+                args.hr_size, args.hr_size,
+                args.scale,
+                crops_per_image,
+                media_type,
+                channels,
+                colorspace
+            )
+            result = run(loader, workers, args.batches, args.warmup)
+            result.update(config)
+            results.append(result)
+            print(">> {}: {:.2f} batches/s, p50 {:.1f}ms, p99 {:.1f}ms".format(
+                config, result['batches_per_sec'], result['latency_ms']['p50'], result['latency_ms']['p99']))
+    finally:
+        if args.datapath is None:
+            shutil.rmtree(datapath, ignore_errors=True)
+
+    report = {
+        'commit': git_commit(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'synthetic': {'images': args.images, 'videos': args.videos, 'size': [width, height], 'video_frames': args.video_frames},
+        'scale': args.scale,
+        'hr_size': args.hr_size,
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+        print(">> Results written to", args.output)
+    else:
+        print(json.dumps(report, indent=4))
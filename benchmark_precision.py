@@ -0,0 +1,147 @@
+#!/usr/bin/python3
+# encoding: utf-8
+
+
+import os
+import sys
+sys.path.append('libs/')
+import json
+import shutil
+import platform
+import tempfile
+import numpy as np
+import cv2
+from timeit import default_timer as timer
+from argparse import ArgumentParser
+from keras import backend as K
+from srgan import SRGAN
+from precision import set_precision, supported_precisions, PRECISIONS
+from losses import psnr2 as psnr
+from benchmark_loader import synthetic_frame, git_commit
+
+
+# Sample call
+"""
+# Compare bfloat16 and float32 step times and outputs of a trained 4X generator
+python3 benchmark_precision.py --scale 4 --generator_weights ./model/SRGAN_generator_4X.h5 --output bench_precision.json
+"""
+
+def parse_args():
+    parser = ArgumentParser(description='Step time and PSNR of the SRGAN networks in each precision')
+
+    parser.add_argument('-p', '--precisions', type=str, nargs='+', default=list(PRECISIONS), help='Precisions to benchmark, float32 first as reference')
+    parser.add_argument('-sc', '--scale', type=int, default=4, help='Upscaling factor')
+    parser.add_argument('-hr', '--hr_size', type=int, default=96, help='Size of the HR crops')
+    parser.add_argument('-bs', '--batch_size', type=int, default=16, help='Batch size')
+    parser.add_argument('-ns', '--steps', type=int, default=20, help='Timed steps per network')
+    parser.add_argument('-wu', '--warmup', type=int, default=3, help='Untimed steps per network')
+    parser.add_argument('-gw', '--generator_weights', type=str, default=None, help='Trained generator, for a meaningful PSNR against HR (random weights if not set)')
+    parser.add_argument('-vgg', '--vgg_layer', type=str, default='block5_conv4', help='VGG19 layer of the content loss features')
+    parser.add_argument('-o', '--output', type=str, default=None, help='JSON file with the results (stdout if not set)')
+
+    return parser.parse_args()
+
+def synthetic_batch(batch_size, hr_size, scale, seed=0):
+    """uint8 HR crops and their blurred bicubic LR versions, as the loader builds them"""
+    rng = np.random.RandomState(seed)
+    imgs_hr = np.array([synthetic_frame(hr_size, hr_size, rng) for _ in range(batch_size)])
+    lr_size = hr_size // scale
+    imgs_lr = np.array([cv2.resize(cv2.GaussianBlur(img, (5, 5), 0), (lr_size, lr_size), interpolation=cv2.INTER_CUBIC) for img in imgs_hr])
+    return imgs_lr, imgs_hr
+
+def time_steps(step, steps, warmup):
+    """Mean and p90 ms of a step function"""
+    times = []
+    for i in range(warmup + steps):
+        start = timer()
+        step()
+        if i >= warmup:
+            times.append(timer() - start)
+    times = np.array(times) * 1000
+    return {'mean_ms': float(times.mean()), 'p90_ms': float(np.percentile(times, 90))}
+
+# Run script
+if __name__ == '__main__':
+
+    # Parse command-line arguments
+    args = parse_args()
+
+    imgs_lr, imgs_hr = synthetic_batch(args.batch_size, args.hr_size, args.scale)
+    lr = imgs_lr.astype(np.float32) / 255.
+    hr = imgs_hr.astype(np.float32) / 127.5 - 1
+
+    # All precisions start from the same weights
+    weights_dir = tempfile.mkdtemp(prefix='srgan_precision_')
+    weights = os.path.join(weights_dir, 'initial')
+    reference, results = None, []
+    try:
+        for precision in args.precisions:
+            if precision not in supported_precisions():
+                print(">> {}: not supported by this TensorFlow build, skipped".format(precision))
+                results.append({'precision': precision, 'supported': False})
+                continue
+            K.clear_session()
+            set_precision(precision, force=True)
+            gan = SRGAN(
+                height_lr=args.hr_size // args.scale, width_lr=args.hr_size // args.scale,
+                upscaling_factor=args.scale, vgg_layer=args.vgg_layer, precision=precision
+            )
+            if reference is None:
+                if args.generator_weights:
+                    gan.load_weights(args.generator_weights)
+                gan.save_weights(weights)
+            else:
+                gan.load_weights(
+                    "{}_generator_{}X.h5".format(weights, args.scale),
+                    "{}_discriminator_{}X.h5".format(weights, args.scale)
+                )
+
+            # Outputs before any training step changes the weights
+            sr = gan.generator.predict(lr, batch_size=args.batch_size)
+            sr = np.clip((sr + 1) * 127.5, 0, 255)
+            result = {
+                'precision': precision,
+                'psnr_hr': float(np.mean([psnr(s, h, 255.) for s, h in zip(sr, imgs_hr)])),
+                'inference': time_steps(lambda: gan.generator.predict(lr, batch_size=args.batch_size), args.steps, args.warmup),
+            }
+            if reference is None:
+                reference = sr
+            else:
+                # Fidelity of the outputs to the float32 ones
+                result['psnr_float32'] = float(np.mean([psnr(s, r, 255.) for s, r in zip(sr, reference)]))
+
+            real = np.ones((args.batch_size,) + gan.discriminator.output_shape[1:])
+            labels = np.concatenate([real, np.zeros_like(real)])
+
+            def gan_step():
+                gan.discriminator.trainable = True
+                gan.discriminator.train_on_batch(np.concatenate([hr, gan.generator.predict(lr)]), labels)
+                gan.discriminator.trainable = False
+                gan.srgan.train_on_batch(lr, [hr, real])
+
+            result['generator_mse_step'] = time_steps(lambda: gan.generator.train_on_batch(lr, hr), args.steps, args.warmup)
+            result['gan_step'] = time_steps(gan_step, args.steps, args.warmup)
+            results.append(result)
+            print(">> {}: inference {:.1f}ms, MSE step {:.1f}ms, GAN step {:.1f}ms, PSNR {:.2f}".format(
+                precision, result['inference']['mean_ms'], result['generator_mse_step']['mean_ms'],
+                result['gan_step']['mean_ms'], result['psnr_hr']))
+    finally:
+        shutil.rmtree(weights_dir, ignore_errors=True)
+
+    report = {
+        'commit': git_commit(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'scale': args.scale,
+        'hr_size': args.hr_size,
+        'batch_size': args.batch_size,
+        'generator_weights': args.generator_weights,
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+        print(">> Results written to", args.output)
+    else:
+        print(json.dumps(report, indent=4))
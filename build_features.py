@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+# encoding: utf-8
+
+
+import os
+import sys
+sys.path.append('libs/')
+from argparse import ArgumentParser
+from losses import VGGLoss
+from shards import PatchShards, build_feature_cache
+
+
+# Sample call
+"""
+# Cache the VGG features of the HR patches once, then train the SRGAN stage against them
+python3 build_patches.py --train ../../data/train_large/ --output ../../data/train_patches_2X/ --scale 2
+python3 build_features.py --patches ../../data/train_patches_2X/ --vgg_layer block5_conv4
+python3 train.py --train ../../data/train_patches_2X/ --media_type p --scale 2 --stage gan --vgg_feature_cache
+"""
+
+def parse_args():
+    parser = ArgumentParser(description='Cache the VGG features of the HR patch shards used by the SRGAN content loss')
+
+    parser.add_argument(
+        '-p', '--patches',
+        type=str, default='../../data/train_patches/',
+        help='Folder with the patch shards'
+    )
+
+    parser.add_argument(
+        '-vgg', '--vgg_layer',
+        type=str, default='block5_conv4',
+        help='VGG19 layer of the content loss features, as given to train.py'
+    )
+
+    parser.add_argument(
+        '-c', '--channels',
+        type=int, default=3,
+        help='channels of images, as given to train.py'
+    )
+
+    parser.add_argument(
+        '-bs', '--batch_size',
+        type=int, default=64,
+        help='Patches per VGG forward'
+    )
+
+    return parser.parse_args()
+
+# Run script
+if __name__ == '__main__':
+
+    # Parse command-line arguments
+    args = parse_args()
+
+    meta = PatchShards(args.patches).meta
+    vgg_loss = VGGLoss((meta['height_hr'], meta['width_hr'], args.channels), args.vgg_layer)
+    build_feature_cache(args.patches, vgg_loss, args.channels, args.batch_size)
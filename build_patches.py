@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+# encoding: utf-8
+
+
+import os
+import sys
+sys.path.append('libs/')
+from argparse import ArgumentParser
+from util import DataLoader
+from shards import build_patch_shards
+
+
+# Sample call
+"""
+# Pre-extract 2X patches once, then train from the shards
+python3 build_patches.py --train ../../data/train_large/ --output ../../data/train_patches_2X/ --scale 2 --crops_per_image 4
+python3 train.py --train ../../data/train_patches_2X/ --media_type p --scale 2 --stage all
+"""
+
+def parse_args():
+    parser = ArgumentParser(description='Build LR/HR patch shards for SRGAN training')
+
+    parser.add_argument(
+        '-t', '--train',
+        type=str, default='../../data/train_large/',
+        help='Folder with training images'
+    )
+
+    parser.add_argument(
+        '-o', '--output',
+        type=str, default='../../data/train_patches/',
+        help='Folder where the shards are written'
+    )
+
+    parser.add_argument(
+        '-sc', '--scale',
+        type=int, default=2,
+        help='How much should we upscale images'
+    )
+
+    parser.add_argument(
+        '-hlr', '--height_lr',
+        type=int, default=48,
+        help='height of lr crop'
+    )
+
+    parser.add_argument(
+        '-wlr', '--width_lr',
+        type=int, default=48,
+        help='width of lr crop'
+    )
+
+    parser.add_argument(
+        '-cpi', '--crops_per_image',
+        type=int, default=4,
+        help='How many random crops to extract from each image'
+    )
+
+    parser.add_argument(
+        '-ss', '--shard_size',
+        type=int, default=4096,
+        help='Number of patches per shard file'
+    )
+
+    parser.add_argument(
+        '-cs', '--colorspace',
+        type=str, default='RGB',
+        help='Colorspace of images, e.g., RGB or YCbCr'
+    )
+
+    parser.add_argument(
+        '-tf', '--texture_floor',
+        type=float, default=None,
+        help='Draw crops from textured areas, with this share of uniform positions between 0 and 1. Uniform if not set'
+    )
+
+    parser.add_argument(
+        '-sd', '--seed',
+        type=int, default=None,
+        help='Seed for the random crops'
+    )
+
+    return parser.parse_args()
+
+# Run script
+if __name__ == '__main__':
+
+    # Parse command-line arguments
+    args = parse_args()
+
+    loader = DataLoader(
+        args.train, 1,
+        args.height_lr*args.scale, args.width_lr*args.scale,
+        args.scale,
+        args.crops_per_image,
+        'i',
+        3,
+        args.colorspace,
+        texture_floor=args.texture_floor
+    )
+    build_patch_shards(loader, args.output, shard_size=args.shard_size, seed=args.seed)
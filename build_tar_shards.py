@@ -0,0 +1,56 @@
+#!/usr/bin/python3
+# encoding: utf-8
+
+
+import os
+import sys
+sys.path.append('libs/')
+from argparse import ArgumentParser
+from manifest import Manifest
+from tarshards import write_tar_shards
+
+
+# Sample call
+"""
+# Pack a dataset on a network or spinning disk into 1GB tar shards, then stream them
+python3 build_tar_shards.py --train /mnt/nfs/data/train_large/ --output /mnt/nfs/data/train_large_tar/
+python3 train.py --train /mnt/nfs/data/train_large_tar/ --media_type t --stage all
+"""
+
+def parse_args():
+    parser = ArgumentParser(description='Pack a dataset into tar shards read sequentially during SRGAN training')
+
+    parser.add_argument(
+        '-t', '--train',
+        type=str, default='../../data/train_large/',
+        help='Folder with training images or videos'
+    )
+
+    parser.add_argument(
+        '-o', '--output',
+        type=str, default='../../data/train_tar/',
+        help='Folder where the shards are written'
+    )
+
+    parser.add_argument(
+        '-ss', '--shard_size_mb',
+        type=int, default=1024,
+        help='Approximate size of each shard in MB'
+    )
+
+    parser.add_argument(
+        '-sd', '--seed',
+        type=int, default=None,
+        help='Seed for the packing order'
+    )
+
+    return parser.parse_args()
+
+# Run script
+if __name__ == '__main__':
+
+    # Parse command-line arguments
+    args = parse_args()
+
+    paths = Manifest(args.train).paths()
+    write_tar_shards(paths, args.train, args.output, shard_bytes=args.shard_size_mb << 20, seed=args.seed)
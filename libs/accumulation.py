@@ -0,0 +1,74 @@
+import tensorflow as tf
+from keras import backend as K
+from keras.optimizers import Optimizer
+
+
+class AccumulatedOptimizer(Optimizer):
+    """
+    Wraps a Keras optimizer to sum the gradients of `steps` consecutive micro-batches
+    and apply their mean in a single update, for a large effective batch size with
+    the memory of a small one. Each train_on_batch call is one micro-batch.
+
+    BatchNormalization still normalizes with the statistics of each micro-batch and
+    updates its moving averages at every micro-batch, so it behaves as with the
+    micro-batch size, not the effective one.
+    """
+
+    def __init__(self, optimizer, steps=1, **kwargs):
+        """
+        :param Optimizer optimizer: optimizer applying the accumulated gradients
+        :param int steps: micro-batches per update
+        """
+        super(AccumulatedOptimizer, self).__init__(**kwargs)
+        self.optimizer = optimizer
+        self.steps = steps
+        with K.name_scope(self.__class__.__name__):
+            self.iterations = K.variable(0, dtype='int64', name='iterations')
+        # Learning rate callbacks act on the wrapped optimizer
+        self.lr = optimizer.lr
+
+    def get_updates(self, loss, params):
+        # Apply on the last micro-batch of each group
+        apply = K.equal((self.iterations + 1) % self.steps, 0)
+        grads = self.get_gradients(loss, params)
+        accums = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+        mean_grads = [(a + g) / self.steps for a, g in zip(accums, grads)]
+
+        # The wrapped optimizer sees the mean gradient
+        get_gradients = self.optimizer.get_gradients
+        self.optimizer.get_gradients = lambda loss, params: mean_grads
+        try:
+            updates = self.optimizer.get_updates(loss, params)
+        finally:
+            self.optimizer.get_gradients = get_gradients
+        # and only moves its state (weights, moments, iterations) when applying,
+        # its own update ops are left out of the graph run
+        updates = [self.conditional(u, apply) for u in updates]
+
+        # Accumulators are reset after the wrapped optimizer read them
+        with tf.control_dependencies(updates):
+            self.updates = [K.update(a, K.switch(apply, K.zeros_like(a), a + g)) for a, g in zip(accums, grads)]
+            self.updates.append(K.update_add(self.iterations, 1))
+        # With the wrapped optimizer's state, so that it is saved and restored too
+        self.weights = [self.iterations] + accums + self.optimizer.weights
+        return updates + self.updates
+
+    @staticmethod
+    def conditional(update, apply):
+        """The same variable update as an Assign / AssignAdd / AssignSub op, run only when apply is true"""
+        op = getattr(update, 'op', update)
+        if op.type not in ('Assign', 'AssignAdd', 'AssignSub'):
+            raise ValueError('Cannot accumulate the gradients of an optimizer making {} updates'.format(op.type))
+        ref, value = op.inputs[0], op.inputs[1]
+        if op.type == 'Assign':
+            return tf.assign(ref, K.switch(apply, value, tf.identity(ref)))
+        value = value * K.cast(apply, value.dtype)
+        return tf.assign_add(ref, value) if op.type == 'AssignAdd' else tf.assign_sub(ref, value)
+
+    def get_config(self):
+        config = {'steps': self.steps, 'optimizer': {
+            'class_name': self.optimizer.__class__.__name__,
+            'config': self.optimizer.get_config()
+        }}
+        base_config = super(AccumulatedOptimizer, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
@@ -0,0 +1,177 @@
+import os
+import json
+import threading
+import numpy as np
+import h5py
+from keras import backend as K
+from keras import __version__ as keras_version
+
+
+CHECKPOINT_INDEX = 'checkpoints.json'
+
+
+def latest_checkpoint(path):
+    """File of the most recent checkpoint in a folder, None if there is none"""
+    index = os.path.join(path, CHECKPOINT_INDEX)
+    if not os.path.isfile(index):
+        return None
+    with open(index) as f:
+        checkpoints = json.load(f)['checkpoints']
+    return os.path.join(path, checkpoints[-1]['file']) if checkpoints else None
+
+
+def save_weights_h5(path, layers, values):
+    """
+    Keras HDF5 weights file of the layers, as Model.save_weights writes it, from
+    values read beforehand so that it can be written outside of the training thread
+    """
+    values = iter(values)
+    with h5py.File(path, 'w') as f:
+        f.attrs['layer_names'] = [layer.name.encode('utf8') for layer in layers]
+        f.attrs['backend'] = K.backend().encode('utf8')
+        f.attrs['keras_version'] = str(keras_version).encode('utf8')
+        for layer in layers:
+            group = f.create_group(layer.name)
+            names = [w.name.encode('utf8') for w in layer.weights]
+            group.attrs['weight_names'] = names
+            for name in names:
+                value = next(values)
+                dataset = group.create_dataset(name, value.shape, dtype=value.dtype)
+                if value.shape:
+                    dataset[:] = value
+                else:
+                    dataset[()] = value
+
+
+class CheckpointManager(object):
+    """
+    Full training state checkpoints (weights, optimizer states and loop state) in a
+    folder, written by a background thread so that the training step only pays for
+    copying the variables to host memory. A checkpoint taken while the previous one
+    is still being written replaces the pending one. The last `keep` checkpoints
+    are kept, plus the one with the best validation PSNR.
+    """
+
+    def __init__(self, path, keep=3):
+        """
+        :param string path: folder of the checkpoints and of their index
+        :param int keep: number of most recent checkpoints kept, besides the best one
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.keep = keep
+        self.index = {'checkpoints': [], 'best': None}
+        if os.path.isfile(os.path.join(path, CHECKPOINT_INDEX)):
+            with open(os.path.join(path, CHECKPOINT_INDEX)) as f:
+                self.index = json.load(f)
+        self._pending = None
+        self._closed = False
+        self._cond = threading.Condition()
+        # Validation PSNRs reported before their checkpoint is written
+        self._reported = {}
+        self._index_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='checkpoint-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def save(self, epoch, arrays, state, psnr=None, exports=()):
+        """
+        Queue a checkpoint for writing.
+
+        :param int epoch: iteration of the checkpoint
+        :param dict arrays: named numpy arrays of the training state
+        :param dict state: JSON serializable loop state
+        :param float psnr: validation PSNR of these weights, if known
+        :param list exports: (path, layers, values) of Keras weights files written along
+        """
+        with self._cond:
+            if self._pending is not None:
+                print(">> Checkpoint of iteration {} not written, replaced by iteration {}".format(self._pending[0], epoch))
+            self._pending = (epoch, arrays, state, psnr, exports)
+            self._cond.notify_all()
+
+    def report(self, epoch, psnr):
+        """Validation PSNR of the weights of an iteration, known after its checkpoint was taken"""
+        with self._index_lock:
+            entries = [c for c in self.index['checkpoints'] if c['epoch'] == epoch]
+            if not entries:
+                self._reported[epoch] = float(psnr)
+                return
+            entries[0]['psnr'] = float(psnr)
+            self.update_best(entries[0])
+            self.retain()
+
+    def close(self):
+        """Write the queued checkpoint and stop the writer thread"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    @staticmethod
+    def load(path):
+        """Named arrays and loop state of a checkpoint file"""
+        with np.load(path) as data:
+            arrays = {k: data[k] for k in data.files if k != 'state'}
+            state = json.loads(str(data['state']))
+        return arrays, state
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None and not self._closed:
+                    self._cond.wait()
+                if self._pending is None:
+                    return
+                checkpoint, self._pending = self._pending, None
+            try:
+                self.write(*checkpoint)
+            except Exception as e:
+                print(">> Could not write checkpoint of iteration {}: {}".format(checkpoint[0], e))
+
+    def write(self, epoch, arrays, state, psnr=None, exports=()):
+        # Complete files only, a crash while writing leaves the previous ones
+        for path, layers, values in exports:
+            save_weights_h5(path + '.tmp', layers, values)
+            os.rename(path + '.tmp', path)
+        name = 'ckpt-{:08d}.npz'.format(epoch)
+        filename = os.path.join(self.path, name)
+        with open(filename + '.tmp', 'wb') as f:
+            np.savez(f, state=json.dumps(state), **arrays)
+        os.rename(filename + '.tmp', filename)
+
+        with self._index_lock:
+            psnr = self._reported.pop(epoch, psnr)
+            # Reports older than this checkpoint will not find theirs
+            self._reported = {e: p for e, p in self._reported.items() if e > epoch}
+            entry = {'epoch': int(epoch), 'file': name, 'psnr': None if psnr is None else float(psnr)}
+            # A resumed run writing an iteration again replaces its checkpoint
+            self.index['checkpoints'] = [c for c in self.index['checkpoints'] if c['file'] != name] + [entry]
+            if self.index['best'] is not None and self.index['best']['file'] == name:
+                self.index['best'] = None
+            self.update_best(entry)
+            self.retain()
+
+    def update_best(self, entry):
+        best = self.index['best']
+        if entry['psnr'] is not None and (best is None or entry['psnr'] > best['psnr']):
+            self.index['best'] = entry
+
+    def retain(self):
+        """Delete the checkpoints other than the last ones and the best one, then save the index"""
+        checkpoints = self.index['checkpoints']
+        best = self.index['best']
+        kept = checkpoints[-self.keep:] if self.keep > 0 else []
+        if best is not None and best not in kept:
+            kept.insert(0, best)
+        for c in checkpoints:
+            if c not in kept:
+                try:
+                    os.remove(os.path.join(self.path, c['file']))
+                except OSError:
+                    pass
+        self.index['checkpoints'] = kept
+        with open(os.path.join(self.path, CHECKPOINT_INDEX + '.tmp'), 'w') as f:
+            json.dump(self.index, f, indent=4)
+        os.rename(os.path.join(self.path, CHECKPOINT_INDEX + '.tmp'), os.path.join(self.path, CHECKPOINT_INDEX))
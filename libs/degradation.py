@@ -0,0 +1,81 @@
+import numpy as np
+import tensorflow as tf
+from keras import backend as K
+
+
+class BatchDegrader(object):
+    """
+    Builds LR images from batches of uint8 HR crops with TF ops, on the consumer side.
+    The whole batch is flipped / rotated, blurred and downscaled at once, so the
+    loader workers only have to decode and crop.
+    """
+
+    METHODS = {
+        'nearest': tf.image.ResizeMethod.NEAREST_NEIGHBOR,
+        'bilinear': tf.image.ResizeMethod.BILINEAR,
+        'bicubic': tf.image.ResizeMethod.BICUBIC,
+        'area': tf.image.ResizeMethod.AREA
+    }
+
+    def __init__(self, height_hr, width_hr, channels, scale, blur=True, methods=('bicubic',), augment=True):
+        """
+        :param int height_hr: Height of high-resolution crops
+        :param int width_hr: Width of high-resolution crops
+        :param int channels: Image channels
+        :param int scale: Downscaling factor
+        :param bool blur: Gaussian blur (5x5, as cv2.GaussianBlur) before downscaling
+        :param list methods: resize kernels, one is picked at random for each batch
+        :param bool augment: random flips and 90 degrees rotations for each crop
+        """
+        self.methods = list(methods)
+        self.shape_lr = (int(height_hr / scale), int(width_hr / scale))
+
+        self.input = tf.placeholder(tf.uint8, shape=(None, height_hr, width_hr, channels), name='degradation_input')
+        x = tf.cast(self.input, tf.float32)
+
+        if augment:
+            x = self.random_flip(x, axis=2)
+            x = self.random_flip(x, axis=1)
+            if height_hr == width_hr:
+                x = tf.where(self.random_mask(x), tf.transpose(x, [0, 2, 1, 3]), x)
+        self.output_hr = x / 127.5 - 1
+
+        if blur:
+            x = self.gaussian_blur(x, channels)
+        self.output_lr = {}
+        for method in self.methods:
+            lr = tf.image.resize_images(x, self.shape_lr, method=self.METHODS[method])
+            self.output_lr[method] = tf.clip_by_value(tf.round(lr), 0., 255.) / 255.
+
+    @staticmethod
+    def random_mask(x):
+        return tf.random_uniform([tf.shape(x)[0]]) < 0.5
+
+    def random_flip(self, x, axis):
+        return tf.where(self.random_mask(x), tf.reverse(x, [axis]), x)
+
+    @staticmethod
+    def gaussian_blur(x, channels, size=5):
+        """Depthwise gaussian blur with reflected borders, sigma as chosen by cv2 for this size"""
+        sigma = 0.3 * ((size - 1) * 0.5 - 1) + 0.8
+        kernel = np.exp(-(np.arange(size) - size // 2) ** 2 / (2 * sigma ** 2))
+        kernel = np.outer(kernel, kernel)
+        kernel = kernel / kernel.sum()
+        kernel = np.tile(kernel[:, :, None, None], (1, 1, channels, 1)).astype(np.float32)
+        pad = size // 2
+        x = tf.pad(x, [[0, 0], [pad, pad], [pad, pad], [0, 0]], mode='REFLECT')
+        return tf.nn.depthwise_conv2d(x, kernel, strides=[1, 1, 1, 1], padding='VALID')
+
+    def degrade(self, imgs_hr):
+        """Return the scaled (LR, HR) batch for a uint8 HR batch"""
+        method = np.random.choice(self.methods)
+        imgs_lr, imgs_hr = K.get_session().run(
+            [self.output_lr[method], self.output_hr],
+            feed_dict={self.input: imgs_hr}
+        )
+        return imgs_lr, imgs_hr
+
+    def flow(self, generator):
+        """Wrap a generator of uint8 HR batches into a generator of (LR, HR) batches"""
+        for imgs_hr in generator:
+            yield self.degrade(imgs_hr)
@@ -0,0 +1,120 @@
+import os
+import json
+import tensorflow as tf
+from tensorflow.python.ops import collective_ops
+from keras import backend as K
+from keras.callbacks import Callback
+
+
+class MultiWorker(object):
+    """
+    Synchronous data-parallel training over the processes / nodes of a TF_CONFIG
+    cluster, set up as the tf.distribute multi-worker strategy does in graph mode:
+    each worker runs its session on its own tf.train.Server, the optimizers average
+    their gradients over the workers with collective all-reduces before applying
+    them, and worker 0 is the chief. Every worker must build the same graph in the
+    same order, since collectives are matched by their creation order.
+
+    Batch normalization statistics are those of each worker's batches, the chief's
+    are copied to the others with broadcast().
+    """
+
+    # All the workers are in one collective group, with one device each
+    GROUP_KEY = 1
+
+    def __init__(self, cluster, task_index=0):
+        """
+        :param dict cluster: {'worker': ['host:port', ...]}, worker 0 being the chief
+        :param int task_index: worker of this process
+        """
+        if list(cluster) != ['worker']:
+            raise ValueError('The cluster must only have a worker job, worker 0 being the chief. You chose {}'.format(list(cluster)))
+        self.num_workers = len(cluster['worker'])
+        if not 0 <= task_index < self.num_workers:
+            raise ValueError('Task index must be in [0, {}). You chose {}'.format(self.num_workers, task_index))
+        self.cluster = tf.train.ClusterSpec(cluster)
+        self.task_index = task_index
+        self.is_chief = task_index == 0
+        self.server = None
+        self._instance_key = 0
+
+    @classmethod
+    def from_env(cls):
+        """Cluster and task of the TF_CONFIG environment variable"""
+        if 'TF_CONFIG' not in os.environ:
+            raise ValueError('Multi-worker training needs the cluster in the TF_CONFIG environment variable')
+        config = json.loads(os.environ['TF_CONFIG'])
+        task = config.get('task', {})
+        if task.get('type', 'worker') != 'worker':
+            raise ValueError('The task type must be worker. You chose {}'.format(task['type']))
+        return cls(config['cluster'], int(task.get('index', 0)))
+
+    def start(self, config=None):
+        """
+        Set the Keras session on the server of this worker, started on the first call.
+
+        :param tf.ConfigProto config: session config, e.g. of the precision
+        """
+        config = config or tf.ConfigProto()
+        config.experimental.collective_group_leader = '/job:worker/replica:0/task:0'
+        # Ops without a device stay on this worker, other workers are only reached by collectives
+        del config.device_filters[:]
+        config.device_filters.append('/job:worker/task:{}'.format(self.task_index))
+        if self.server is None:
+            self.server = tf.train.Server(self.cluster, job_name='worker', task_index=self.task_index, config=config)
+            print(">> Worker {} of {}{}".format(self.task_index, self.num_workers, " (chief)" if self.is_chief else ""))
+        K.set_session(tf.Session(self.server.target, config=config))
+
+    def all_reduce(self, tensor, merge_op='Add', final_op='Div'):
+        """Mean (or final_op) over the workers of a tensor"""
+        self._instance_key += 1
+        return collective_ops.all_reduce(
+            tf.convert_to_tensor(tensor), self.num_workers, self.GROUP_KEY, self._instance_key, merge_op, final_op
+        )
+
+    def all_reduce_gradients(self, optimizer):
+        """Make a Keras optimizer apply the mean of the gradients of all the workers"""
+        get_gradients = optimizer.get_gradients
+        optimizer.get_gradients = lambda loss, params: [self.all_reduce(g) for g in get_gradients(loss, params)]
+        return optimizer
+
+    def broadcast(self, variables):
+        """Function copying the values of the chief's float variables to all the workers"""
+        # Sum of the chief's values and zeros
+        updates = [K.update(v, self.all_reduce(v * int(self.is_chief), final_op='Id')) for v in variables]
+        function = K.function([], [], updates=updates)
+        return lambda: function([])
+
+
+class ChiefSync(Callback):
+    """
+    Keeps the workers of a Keras fit on the chief's state. The weights and batch
+    normalization statistics are copied after the last batch of each epoch, so that
+    every worker validates the same model, and the learning rate and early stopping
+    decisions of the chief are copied at the end of the epoch, so that no worker
+    stops or changes its learning rate alone. Must be the last callback.
+    """
+
+    def __init__(self, cluster, model, steps_per_epoch):
+        """
+        :param MultiWorker cluster: cluster of the workers
+        :param Model model: compiled model being fit
+        :param int steps_per_epoch: batches per epoch
+        """
+        super(ChiefSync, self).__init__()
+        self.steps_per_epoch = steps_per_epoch
+        self.stop = K.variable(0., name='stop_training')
+        self.sync_weights = cluster.broadcast(model.weights)
+        self.sync_decisions = cluster.broadcast([model.optimizer.lr, self.stop])
+
+    def on_train_begin(self, logs=None):
+        self.sync_weights()
+
+    def on_batch_end(self, batch, logs=None):
+        if batch == self.steps_per_epoch - 1:
+            self.sync_weights()
+
+    def on_epoch_end(self, epoch, logs=None):
+        K.set_value(self.stop, float(self.model.stop_training))
+        self.sync_decisions()
+        self.model.stop_training = bool(K.get_value(self.stop))
@@ -0,0 +1,105 @@
+import os
+import atexit
+import shutil
+import hashlib
+import tempfile
+import multiprocessing as mp
+import numpy as np
+
+
+class SharedImageCache(object):
+    """
+    Decoded uint8 images shared by the loader processes, kept as .npy files in
+    shared memory (/dev/shm) under a memory budget. Each hit refreshes the file
+    mtime and the least recently used images are evicted when the budget is
+    exceeded. Create it before the enqueuer workers are forked, and close it once
+    they are stopped, or it is removed at exit.
+    """
+
+    def __init__(self, budget_bytes, path=None):
+        """
+        :param int budget_bytes: memory budget of the decoded images
+        :param string path: cache folder, a new one in /dev/shm (or the temp folder) if not set
+        """
+        self.budget_bytes = budget_bytes
+        self.owned = path is None
+        if path is None:
+            path = tempfile.mkdtemp(prefix='srgan_cache_', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        elif not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.used = mp.Value('q', 0)
+        self.pid = os.getpid()
+        if self.owned:
+            atexit.register(self.close)
+
+    def filename(self, key, colorspace):
+        digest = hashlib.sha1('{}|{}'.format(key, colorspace).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest + '.npy')
+
+    def get(self, key, colorspace):
+        """Cached image or None"""
+        filename = self.filename(key, colorspace)
+        try:
+            img = np.load(filename)
+            os.utime(filename, None)
+            return img
+        except (IOError, OSError, ValueError):
+            # Missing, or evicted by another worker while being read
+            return None
+
+    def put(self, key, colorspace, img):
+        if img.nbytes > self.budget_bytes:
+            return
+        filename = self.filename(key, colorspace)
+        tmp = '{}.{}.tmp'.format(filename, os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                np.save(f, img)
+            size = os.path.getsize(tmp)
+            os.rename(tmp, filename)
+        except (IOError, OSError) as e:
+            print(">> Could not cache {}: {}".format(key, e))
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+            return
+        with self.used.get_lock():
+            self.used.value += size
+            over = self.used.value > self.budget_bytes
+        if over:
+            self.evict()
+
+    def load(self, key, colorspace, decode):
+        """Cached image, decoded with decode() and cached on a miss"""
+        img = self.get(key, colorspace)
+        if img is None:
+            img = decode()
+            self.put(key, colorspace, img)
+        return img
+
+    def evict(self):
+        """Remove the least recently used images down to 90% of the budget"""
+        with self.used.get_lock():
+            entries = []
+            for entry in os.scandir(self.path):
+                if entry.name.endswith('.npy'):
+                    try:
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    except OSError:
+                        pass
+            # Recount from the files, concurrent puts of an image count it twice
+            used = sum(size for _, size, _ in entries)
+            for _, size, filename in sorted(entries):
+                if used <= 0.9 * self.budget_bytes:
+                    break
+                try:
+                    os.remove(filename)
+                    used -= size
+                except OSError:
+                    pass
+            self.used.value = used
+
+    def close(self):
+        if self.owned and os.getpid() == self.pid:
+            shutil.rmtree(self.path, ignore_errors=True)
@@ -4,7 +4,7 @@ import numpy as np
 import keras.backend as K
 from keras.models import Model
 from keras.optimizers import Adam
-from keras.layers import Conv2D, Lambda, MaxPooling2D
+from keras.layers import Input, Conv2D, Lambda, MaxPooling2D
 from keras.applications.vgg19 import VGG19
 from keras.utils import data_utils as keras_utils
 from keras.applications.vgg19 import preprocess_input
@@ -15,7 +15,12 @@ class VGGLossNoActivation(object):
     after activation as practiced in SRGAN. 
     Reference: https://arxiv.org/abs/1809.00219"""
 
-    def __init__(self, image_shape):
+    def __init__(self, image_shape, layer='block5_conv4'):
+        """
+        :param tuple image_shape: shape of the HR images
+        :param str layer: VGG19 convolution giving the features, earlier ones are cheaper
+        """
+        self.layer = layer
         self.model = self.create_model(image_shape)
         
     def create_model(self,image_shape):
@@ -26,11 +31,13 @@ class VGGLossNoActivation(object):
                        'releases/download/v0.1/'
                        'vgg19_weights_tf_dim_ordering_tf_kernels_notop.h5')
         vgg19 = VGG19(include_top=False, weights=None, input_shape=image_shape)
-        # Block 5 without activation relu
-        x = Conv2D(512, (3, 3),
+        # Feature layer without activation relu
+        conv = vgg19.get_layer(self.layer)
+        previous = vgg19.layers[vgg19.layers.index(conv) - 1]
+        x = Conv2D(conv.filters, conv.kernel_size,
                       # activation='relu',
                       padding='same',
-                      name='block5_conv4')(vgg19.get_layer('block5_conv3').output)
+                      name=self.layer)(previous.output)
         #x = MaxPooling2D((2, 2), strides=(2, 2), name='block5_pool')(x)
         model = Model(inputs=vgg19.input, outputs=x)
         weights_path = keras_utils.get_file(
@@ -38,7 +45,8 @@ class VGGLossNoActivation(object):
                 WEIGHTS_PATH_NO_TOP,
                 cache_subdir='models',
                 file_hash='253f8cb515780f3b799900260a226db6')
-        model.load_weights(weights_path)
+        # By name, the model stops at the feature layer
+        model.load_weights(weights_path, by_name=True)
         model.trainable = False
         return model
     
@@ -49,47 +57,105 @@ class VGGLossNoActivation(object):
         else:            
             return Lambda(lambda x: preprocess_input(tf.add(x, 1) * 127.5))(x)
         
+    def features(self, y_true, y_pred):
+        """VGG features of both images, batched through a single pass"""
+        n = K.shape(y_true)[0]
+        x = self.model(self.preprocess_vgg(K.concatenate([y_true, y_pred], axis=0)))
+        return x[:n], x[n:]
+
     # computes VGG loss or content loss
     def content_loss(self, y_true, y_pred):
-        return 1e-5 * K.mean(K.square(self.model(self.preprocess_vgg(y_true)) - self.model(self.preprocess_vgg(y_pred))),None)
+        f_true, f_pred = self.features(y_true, y_pred)
+        return 1e-5 * K.mean(K.square(f_true - f_pred),None)
     
     def euclidean_content_loss(self, y_true, y_pred):
-        return K.sqrt(K.sum(K.square(self.model(self.preprocess_vgg(y_true)) - self.model(self.preprocess_vgg(y_pred))), axis=None))
+        f_true, f_pred = self.features(y_true, y_pred)
+        return K.sqrt(K.sum(K.square(f_true - f_pred), axis=None))
     
     def plus_content_loss(self, y_true, y_pred):
-        return (1e-5 * K.mean(K.square(self.model(self.preprocess_vgg(y_true)) - self.model(self.preprocess_vgg(y_pred))),None) + K.mean(K.square(y_pred - y_true), axis=None))
+        f_true, f_pred = self.features(y_true, y_pred)
+        return (1e-5 * K.mean(K.square(f_true - f_pred),None) + K.mean(K.square(y_pred - y_true), axis=None))
 
 
 
 class VGGLoss(object):
 
-    def __init__(self, image_shape):
+    def __init__(self, image_shape, layer='block5_conv4'):
+        """
+        :param tuple image_shape: shape of the HR images
+        :param str layer: VGG19 layer giving the features, the network is truncated after it
+        """
         self.image_shape = image_shape
-        self.vgg19 = VGG19(include_top=False, weights='imagenet', input_shape=self.image_shape)
+        self.layer = layer
+        self.channels = image_shape[-1]
+        # Tag of the VGG inputs, for the cached features (see build_features.py)
+        self.preprocessing = 'caffe_luma' if self.channels == 1 else 'caffe'
+        # VGG19 takes RGB, single channel (luma) images are handled by luma_model
+        self.vgg19 = VGG19(include_top=False, weights='imagenet', input_shape=tuple(image_shape[:-1]) + (3,))
         self.vgg19.trainable = False
         # Make trainable as False
         for l in self.vgg19.layers:
             l.trainable = False
-        self.model = Model(inputs=self.vgg19.input, outputs=self.vgg19.get_layer('block5_conv4').output)
+        self.model = Model(inputs=self.vgg19.input, outputs=self.vgg19.get_layer(self.layer).output)
+        if self.channels == 1:
+            self.model = self.luma_model(self.model)
         self.model.trainable = False
 
+    def luma_model(self, model):
+        """
+        VGG features of a grey image given as one channel. Replicating it to three
+        channels and the mean subtraction of preprocess_input are folded into the
+        first convolution, so nothing is triplicated per step. Only the zero padding
+        at the image border differs from the RGB model.
+        """
+        kernel, bias = model.get_layer('block1_conv1').get_weights()
+        # preprocess_input gives BGR minus the ImageNet mean
+        mean = np.array([103.939, 116.779, 123.68], dtype=kernel.dtype)
+        bias = bias - mean.dot(kernel.sum(axis=(0, 1)))
+        kernel = kernel.sum(axis=2, keepdims=True)
+
+        img = Input(shape=self.image_shape)
+        first = Conv2D(64, (3, 3), activation='relu', padding='same', name='block1_conv1_luma', trainable=False)
+        x = first(img)
+        for layer in model.layers[2:]:
+            x = layer(x)
+        first.set_weights([kernel, bias])
+        return Model(inputs=img, outputs=x)
 
     def preprocess_vgg(self, x):
         """Take a HR image [-1, 1], convert to [0, 255], then to input for VGG network"""
+        if self.channels == 1:
+            # The mean subtraction is done by the first layer of luma_model
+            if isinstance(x, np.ndarray):
+                return (x+1) * 127.5
+            return Lambda(lambda x: tf.add(x, 1) * 127.5)(x)
         if isinstance(x, np.ndarray):
             return preprocess_input((x+1) * 127.5)
         else:            
             return Lambda(lambda x: preprocess_input(tf.add(x, 1) * 127.5))(x)
     
+    def features(self, y_true, y_pred):
+        """VGG features of both images, batched through a single pass"""
+        n = K.shape(y_true)[0]
+        x = self.model(self.preprocess_vgg(K.concatenate([y_true, y_pred], axis=0)))
+        return x[:n], x[n:]
+
     # computes VGG loss or content loss
     def content_loss(self, y_true, y_pred):
-        return  K.mean(K.square(self.model(self.preprocess_vgg(y_true)) - self.model(self.preprocess_vgg(y_pred))), axis=None)
+        f_true, f_pred = self.features(y_true, y_pred)
+        return  K.mean(K.square(f_true - f_pred), axis=None)
+
+    def cached_content_loss(self, f_true, y_pred):
+        """Content loss with the VGG features of the HR image precomputed, only y_pred runs through VGG"""
+        return K.mean(K.square(f_true - self.model(self.preprocess_vgg(y_pred))), axis=None)
     
     def euclidean_content_loss(self, y_true, y_pred):
-        return K.sqrt(K.sum(K.square(self.model(self.preprocess_vgg(y_true)) - self.model(self.preprocess_vgg(y_pred))), axis=None))
+        f_true, f_pred = self.features(y_true, y_pred)
+        return K.sqrt(K.sum(K.square(f_true - f_pred), axis=None))
     
     def plus_content_loss(self, y_true, y_pred):
-        return (1. * K.mean(K.square(self.model(self.preprocess_vgg(y_true)) - self.model(self.preprocess_vgg(y_pred)))) + K.mean(K.square(y_pred - y_true), axis=None))
+        f_true, f_pred = self.features(y_true, y_pred)
+        return (1. * K.mean(K.square(f_true - f_pred)) + K.mean(K.square(y_pred - y_true), axis=None))
 
 
 
@@ -0,0 +1,133 @@
+import os
+import json
+from PIL import Image
+
+
+MANIFEST = '.manifest.json'
+QUARANTINE = '.quarantine.jsonl'
+IMAGE_EXTENSIONS = ('.jpeg', '.jpg', '.png')
+VIDEO_EXTENSIONS = ('.mp4', '.264', '.webm', '.wma')
+
+
+class Manifest(object):
+    """
+    Cached listing of a dataset folder with size, mtime, width, height and mode of
+    each file, so the image headers are read only once. The mtime of each directory
+    is kept too: only the directories where files were added, removed or renamed
+    since are listed again, and only their new files are read. Files that failed to
+    load are appended to a quarantine list and skipped until they change (size or
+    mtime).
+    """
+
+    def __init__(self, datapath, refresh=False):
+        """
+        :param string datapath: dataset folder
+        :param bool refresh: check the size and mtime of every file, e.g. after files were overwritten in place
+        """
+        self.datapath = datapath
+        self.entries, self.dirs = {}, {}
+        path = os.path.join(datapath, MANIFEST)
+        if os.path.isfile(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            # Manifests without directories list every directory again
+            if 'dirs' in manifest:
+                self.entries, self.dirs = manifest['files'], manifest['dirs']
+            else:
+                self.entries = manifest
+        if self.scan(full=refresh):
+            self.save()
+        self.quarantined = self.load_quarantine()
+
+    def scan(self, full=False):
+        """Walk the folder, reading the new files of changed directories only unless full, and tell if the files changed"""
+        old, old_dirs = self.entries, self.dirs
+        self.entries, self.dirs = {}, {}
+        by_dir = {}
+        for rel, entry in old.items():
+            by_dir.setdefault(os.path.dirname(rel), {})[rel] = entry
+        for dirpath, _, filenames in os.walk(self.datapath):
+            rel_dir = os.path.relpath(dirpath, self.datapath)
+            rel_dir = '' if rel_dir == '.' else rel_dir
+            mtime = os.stat(dirpath).st_mtime
+            self.dirs[rel_dir] = mtime
+            if not full and old_dirs.get(rel_dir) == mtime:
+                self.entries.update(by_dir.get(rel_dir, {}))
+                continue
+            for filename in filenames:
+                if not filename.lower().endswith(IMAGE_EXTENSIONS + VIDEO_EXTENSIONS):
+                    continue
+                rel = os.path.join(rel_dir, filename)
+                entry = old.get(rel)
+                if entry is not None and not full:
+                    self.entries[rel] = entry
+                    continue
+                path = os.path.join(dirpath, filename)
+                stat = os.stat(path)
+                if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+                    entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'width': None, 'height': None, 'mode': None}
+                    if filename.lower().endswith(IMAGE_EXTENSIONS):
+                        try:
+                            # Only the header is read
+                            img = Image.open(path)
+                            entry['width'], entry['height'] = img.size
+                            entry['mode'] = img.mode
+                        except Exception as e:
+                            entry['error'] = str(e)
+                self.entries[rel] = entry
+        # Directories changed by the manifest and quarantine files alone are listed again, but not saved each time
+        return self.entries != old or set(self.dirs) != set(old_dirs)
+
+    def save(self):
+        # Complete files only, other processes may read it meanwhile
+        path = os.path.join(self.datapath, MANIFEST)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'dirs': self.dirs, 'files': self.entries}, f)
+            os.rename(tmp, path)
+        except (IOError, OSError) as e:
+            print(">> Could not write dataset manifest: {}".format(e))
+
+    def load_quarantine(self):
+        quarantined = {}
+        path = os.path.join(self.datapath, QUARANTINE)
+        if os.path.isfile(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        quarantined[record['path']] = record
+                    except ValueError:
+                        pass
+        return quarantined
+
+    def is_quarantined(self, rel):
+        record, entry = self.quarantined.get(rel), self.entries.get(rel)
+        return record is not None and entry is not None and \
+            (record['size'], record['mtime']) == (entry['size'], entry['mtime'])
+
+    def quarantine(self, path, error):
+        """Record a file that failed to load, shared by all processes through the quarantine file"""
+        rel = os.path.relpath(path, self.datapath)
+        entry = self.entries.get(rel)
+        if entry is None or self.is_quarantined(rel):
+            return
+        record = {'path': rel, 'size': entry['size'], 'mtime': entry['mtime'], 'error': str(error)}
+        self.quarantined[rel] = record
+        try:
+            with open(os.path.join(self.datapath, QUARANTINE), 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        except (IOError, OSError) as e:
+            print(">> Could not write quarantine: {}".format(e))
+
+    def paths(self, min_height=0, min_width=0):
+        """Sorted paths of the readable files, images smaller than the minimum size excluded"""
+        paths = []
+        for rel, entry in sorted(self.entries.items()):
+            if 'error' in entry or self.is_quarantined(rel):
+                continue
+            if entry['width'] is not None and (entry['width'] < min_width or entry['height'] < min_height):
+                continue
+            paths.append(os.path.join(self.datapath, rel))
+        return paths
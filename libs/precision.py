@@ -0,0 +1,62 @@
+import os
+import tensorflow as tf
+from tensorflow.core.protobuf.rewriter_config_pb2 import RewriterConfig
+from keras import backend as K
+
+
+PRECISIONS = ('float32', 'mixed_bfloat16')
+
+# Kept in float32 by the rewrite: the tanh / sigmoid outputs and the reductions of the losses
+FLOAT32_OPS = ['Tanh', 'Sigmoid', 'Log', 'Log1p', 'Exp', 'Square', 'SquaredDifference', 'Sqrt', 'Sum', 'Mean']
+
+_configured = 'float32'
+
+
+def bfloat16_rewrite():
+    """Option of the oneDNN bfloat16 grappler rewrite (names before and after TF 2.4), None if this TensorFlow has none, as TF1"""
+    fields = RewriterConfig.DESCRIPTOR.fields_by_name
+    for option in ['auto_mixed_precision_onednn_bfloat16', 'auto_mixed_precision_mkl']:
+        if option in fields:
+            return option
+    return None
+
+
+def supported_precisions():
+    """The PRECISIONS this TensorFlow can run"""
+    return tuple(p for p in PRECISIONS if p != 'mixed_bfloat16' or bfloat16_rewrite() is not None)
+
+
+def set_precision(precision='float32', force=False):
+    """
+    Run the Keras session in the given precision. 'mixed_bfloat16' enables the
+    grappler bfloat16 rewrite of oneDNN builds: variables (master weights) and the
+    optimizer stay in float32, convolutions and matmuls run in bfloat16. bfloat16
+    has the float32 exponent range, so no loss scaling is needed. TF1 has no such
+    rewrite, see supported_precisions.
+    Must be called before the models are built, as it replaces the session.
+
+    :param str precision: one of PRECISIONS
+    :param bool force: configure a new session even if the precision is unchanged (e.g. after K.clear_session)
+    """
+    global _configured
+    if precision == _configured and not force:
+        return
+    K.set_session(tf.Session(config=session_config(precision)))
+    _configured = precision
+    print(">> Running in {} precision".format(precision))
+
+
+def session_config(precision='float32'):
+    """Session config running the graph in the given precision, see set_precision"""
+    if precision not in PRECISIONS:
+        raise ValueError('Precision must be one of {}. You chose {}'.format(PRECISIONS, precision))
+    config = tf.ConfigProto()
+    if precision == 'mixed_bfloat16':
+        option = bfloat16_rewrite()
+        if option is None:
+            raise ValueError('mixed_bfloat16 needs a TensorFlow build with the oneDNN bfloat16 graph rewrite, TensorFlow {} has none'.format(tf.__version__))
+        # Lists read by the rewrite when it is created (names before and after TF 2.4)
+        for name in ['DENYLIST', 'BLACKLIST']:
+            os.environ['TF_AUTO_MIXED_PRECISION_GRAPH_REWRITE_{}_ADD'.format(name)] = ','.join(FLOAT32_OPS)
+        setattr(config.graph_options.rewrite_options, option, RewriterConfig.ON)
+    return config
@@ -0,0 +1,72 @@
+import json
+import numpy as np
+
+
+class ShardedSampler(object):
+    """
+    Deterministic and resumable order of the dataset items for a DataLoader.
+    Each of num_shards processes or nodes gets a disjoint shard of the items, and
+    each epoch visits its shard in a permutation drawn from the seed. The order only
+    depends on (seed, shard, step), so it can be resumed from a saved step.
+    """
+
+    def __init__(self, num_shards=1, shard_index=0, seed=0, step=0):
+        """
+        :param int num_shards: number of processes / nodes splitting the dataset
+        :param int shard_index: shard of this process, in [0, num_shards)
+        :param int seed: seed of the per-epoch permutations and of the random crops
+        :param int step: first batch to draw (number of batches already consumed)
+        """
+        if not 0 <= shard_index < num_shards:
+            raise ValueError('Shard index must be in [0, {}). You chose {}'.format(num_shards, shard_index))
+        self.num_shards = num_shards
+        self.shard_index = shard_index
+        self.seed = seed
+        self.step = step
+        self.items = None
+        self.batch_size = None
+        self._permutation = (None, None)
+
+    def set_size(self, num_items, batch_size):
+        """Called by the DataLoader with its number of items and items per batch"""
+        self.items = np.arange(num_items)[self.shard_index::self.num_shards]
+        self.batch_size = batch_size
+        if len(self) == 0:
+            raise ValueError('Shard {} of {} has less than one batch'.format(self.shard_index, self.num_shards))
+
+    def __len__(self):
+        """Batches per epoch"""
+        return len(self.items) // self.batch_size
+
+    def permutation(self, epoch):
+        if self._permutation[0] != epoch:
+            rng = np.random.RandomState([self.seed, epoch])
+            self._permutation = (epoch, self.items[rng.permutation(len(self.items))])
+        return self._permutation[1]
+
+    def batch(self, step):
+        """Item indexes of a batch"""
+        epoch, b = divmod(step, len(self))
+        return self.permutation(epoch)[b*self.batch_size:(b+1)*self.batch_size]
+
+    def batch_seed(self, step):
+        """Seed for the random crops of a batch, so they do not depend on which worker loads it"""
+        return (self.seed * 1000003 + self.shard_index * 7919 + step) % (2**32)
+
+    def state(self, step):
+        return {
+            'num_shards': self.num_shards,
+            'shard_index': self.shard_index,
+            'seed': self.seed,
+            'step': int(step)
+        }
+
+    def save(self, path, step):
+        """Save the position after step consumed batches"""
+        with open(path, 'w') as f:
+            json.dump(self.state(step), f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(**json.load(f))
@@ -0,0 +1,190 @@
+import os
+import json
+import time
+import hashlib
+import numpy as np
+
+
+SHARDS_META = 'shards.json'
+
+
+def features_meta(layer):
+    """Metadata file of the VGG feature cache of a layer"""
+    return 'vgg_{}.json'.format(layer)
+
+
+def shards_fingerprint(meta):
+    """Hash of the shards.json metadata, which differs for each build of the shards"""
+    return hashlib.sha1(json.dumps(meta, sort_keys=True).encode('utf8')).hexdigest()
+
+
+class PatchShards(object):
+    """
+    Memory-mapped reader for the LR/HR patch shards written by build_patch_shards.
+    Each shard is a pair of uint8 .npy files (N x H x W x C), so reading a batch
+    is just index gathers with no decode or resize.
+    """
+
+    def __init__(self, path):
+        """
+        :param string path: folder with the shards and the shards.json metadata
+        """
+        self.path = path
+        with open(os.path.join(path, SHARDS_META)) as f:
+            self.meta = json.load(f)
+        self.counts = [s['count'] for s in self.meta['shards']]
+        self.offsets = np.cumsum([0] + self.counts)
+        self.hr, self.lr = None, None
+        self.features_meta, self.features = None, None
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getstate__(self):
+        # Memory maps are re-opened in each worker instead of being pickled
+        state = self.__dict__.copy()
+        state['hr'], state['lr'], state['features'] = None, None, None
+        return state
+
+    def use_features(self, layer, preprocessing, channels):
+        """Gather the cached VGG features of the HR patches too, checking what they were built with"""
+        path = os.path.join(self.path, features_meta(layer))
+        if not os.path.isfile(path):
+            raise ValueError('No VGG {} feature cache in {}, build it with build_features.py'.format(layer, self.path))
+        with open(path) as f:
+            meta = json.load(f)
+        if (meta['preprocessing'], meta['channels']) != (preprocessing, channels):
+            raise ValueError('VGG features in {} were built with {} preprocessing on {} channels'.format(
+                path, meta['preprocessing'], meta['channels']))
+        # Patches written again in the same folder leave the features of the previous ones
+        if meta.get('shards_fingerprint') != shards_fingerprint(self.meta):
+            raise ValueError('VGG features in {} were built for other patches, build them again with build_features.py'.format(path))
+        self.features_meta = meta
+
+    def open(self):
+        """Memory-map all shards (lazy, once per process)"""
+        if self.hr is None:
+            self.hr = [np.load(os.path.join(self.path, s['hr']), mmap_mode='r') for s in self.meta['shards']]
+            self.lr = [np.load(os.path.join(self.path, s['lr']), mmap_mode='r') for s in self.meta['shards']]
+        if self.features_meta is not None and self.features is None:
+            self.features = [np.load(os.path.join(self.path, f), mmap_mode='r') for f in self.features_meta['files']]
+
+    def gather(self, idxs):
+        """Read the LR/HR patches at the given global indexes, as uint8 arrays, and their float32 VGG features if used"""
+        self.open()
+        idxs = np.sort(np.asarray(idxs))
+        shard_ids = np.searchsorted(self.offsets, idxs, side='right') - 1
+        imgs_hr = np.empty((len(idxs),) + self.hr[0].shape[1:], dtype=np.uint8)
+        imgs_lr = np.empty((len(idxs),) + self.lr[0].shape[1:], dtype=np.uint8)
+        features = None
+        if self.features is not None:
+            features = np.empty((len(idxs),) + self.features[0].shape[1:], dtype=np.float32)
+        for s in np.unique(shard_ids):
+            mask = shard_ids == s
+            local = idxs[mask] - self.offsets[s]
+            imgs_hr[mask] = self.hr[s][local]
+            imgs_lr[mask] = self.lr[s][local]
+            if features is not None:
+                features[mask] = self.features[s][local]
+        if features is not None:
+            return imgs_lr, imgs_hr, features
+        return imgs_lr, imgs_hr
+
+
+def build_patch_shards(loader, output_path, shard_size=4096, seed=None):
+    """
+    Walk loader.img_paths once and write fixed-shape uint8 HR crops and their
+    degraded LR versions into shard files readable by PatchShards.
+
+    :param DataLoader loader: image loader with the crop size, scale, crops_per_image and colorspace to use
+    :param string output_path: folder where shards are written
+    :param int shard_size: number of patches per shard
+    :param int seed: seed for the random crops
+    """
+    if seed is not None:
+        np.random.seed(seed)
+    if not os.path.isdir(output_path):
+        os.makedirs(output_path)
+
+    shards = []
+    imgs_hr, imgs_lr = [], []
+
+    def flush():
+        name = 'shard_{:05d}'.format(len(shards))
+        np.save(os.path.join(output_path, name + '_hr.npy'), np.array(imgs_hr, dtype=np.uint8))
+        np.save(os.path.join(output_path, name + '_lr.npy'), np.array(imgs_lr, dtype=np.uint8))
+        shards.append({'hr': name + '_hr.npy', 'lr': name + '_lr.npy', 'count': len(imgs_hr)})
+        print(">> Written {} with {} patches".format(name, len(imgs_hr)))
+        del imgs_hr[:], imgs_lr[:]
+
+    for path in loader.img_paths:
+        try:
+            img = loader.load_img(path, loader.colorspace)
+            for _ in range(loader.crops_per_image):
+                img_hr = loader.random_crop(img, (loader.height_hr, loader.width_hr), path)
+                imgs_hr.append(img_hr)
+                imgs_lr.append(loader.degrade_image(img_hr))
+                if len(imgs_hr) >= shard_size:
+                    flush()
+        except Exception as e:
+            print(e)
+    if imgs_hr:
+        flush()
+
+    meta = {
+        'height_hr': loader.height_hr,
+        'width_hr': loader.width_hr,
+        'scale': loader.scale,
+        'colorspace': loader.colorspace,
+        'crops_per_image': loader.crops_per_image,
+        'seed': seed,
+        # Builds with the same seed and counts are told apart
+        'created': time.time(),
+        'shards': shards
+    }
+    with open(os.path.join(output_path, SHARDS_META), 'w') as f:
+        json.dump(meta, f, indent=4)
+    print(">> Written {} patches in {} shards".format(sum(s['count'] for s in shards), len(shards)))
+    return meta
+
+
+def build_feature_cache(path, vgg_loss, channels=3, batch_size=64):
+    """
+    Compute once the VGG features of every HR patch of the shards in path, so that
+    the perceptual loss only runs VGG on the generated images. Features are stored
+    as float16 .npy files next to the shards, tagged with the layer and preprocessing.
+
+    :param string path: folder with the patch shards
+    :param VGGLoss vgg_loss: perceptual loss giving the layer, preprocessing and network
+    :param int channels: channels of the patches used for training
+    :param int batch_size: patches per VGG forward
+    """
+    shards = PatchShards(path)
+    shards.open()
+    files = []
+    for s, (meta, imgs_hr) in enumerate(zip(shards.meta['shards'], shards.hr)):
+        name = '{}_vgg_{}.npy'.format(os.path.splitext(meta['hr'])[0], vgg_loss.layer)
+        out = None
+        for start in range(0, len(imgs_hr), batch_size):
+            batch = imgs_hr[start:start + batch_size, :, :, :channels].astype(np.float32) / 127.5 - 1
+            features = vgg_loss.model.predict(vgg_loss.preprocess_vgg(batch))
+            if out is None:
+                out = np.lib.format.open_memmap(
+                    os.path.join(path, name), mode='w+', dtype=np.float16, shape=(len(imgs_hr),) + features.shape[1:])
+            out[start:start + len(features)] = features
+        out.flush()
+        del out
+        files.append(name)
+        print(">> Written {}".format(name))
+
+    meta = {
+        'layer': vgg_loss.layer,
+        'preprocessing': vgg_loss.preprocessing,
+        'channels': channels,
+        'dtype': 'float16',
+        'shards_fingerprint': shards_fingerprint(shards.meta),
+        'files': files
+    }
+    with open(os.path.join(path, features_meta(vgg_loss.layer)), 'w') as f:
+        json.dump(meta, f, indent=4)
+    return meta
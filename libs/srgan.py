@@ -10,6 +10,7 @@ warnings.filterwarnings("ignore")
 #sys.stderr = open(os.devnull, 'w')
 
 import datetime
+from timeit import default_timer as timer
 import tensorflow as tf
 import numpy as np
 import restore
@@ -26,6 +27,14 @@ from keras import backend as K
 from tqdm import tqdm
 
 from util import DataLoader, plot_test_images 
+from degradation import BatchDegrader
+from transport import SharedMemoryEnqueuer
+from telemetry import LoaderStats, LoaderTelemetry
+from validation import FixedValidationSet, BackgroundValidator
+from precision import set_precision, session_config
+from accumulation import AccumulatedOptimizer
+from checkpoint import CheckpointManager, latest_checkpoint
+from distributed import ChiefSync
 
 from losses import psnr3 as psnr
 from losses import VGGLoss
@@ -44,7 +53,11 @@ class SRGAN():
         upscaling_factor=4, 
         gen_lr=1e-4, dis_lr=1e-4, loss_weights=[0.006, 1e-4], 
         training_mode=True,
-        colorspace = 'RGB'
+        colorspace = 'RGB',
+        vgg_layer='block5_conv4',
+        precision='float32',
+        accumulation_steps=1,
+        cluster=None
     ):
                  
         """        
@@ -54,7 +67,19 @@ class SRGAN():
         :param int upscaling_factor: Up-scaling factor
         :param int gen_lr: Learning rate of generator
         :param int dis_lr: Learning rate of discriminator
+        :param str vgg_layer: VGG19 layer of the content loss features, e.g. block2_conv2 or block3_conv4 for a cheaper truncated network
+        :param str precision: 'float32', or 'mixed_bfloat16' for bfloat16 compute with float32 weights on CPUs supporting it
+        :param int accumulation_steps: micro-batches whose gradients are averaged into each optimizer update
+        :param MultiWorker cluster: train data-parallel over the workers of this cluster, None for a single process
         """
+
+        # Session precision, before any model is built
+        self.precision = precision
+        self.cluster = cluster
+        if cluster is None:
+            set_precision(precision)
+        else:
+            cluster.start(session_config(precision))
         
         
         # Low-resolution image dimensions
@@ -78,10 +103,11 @@ class SRGAN():
         # Learning rates
         self.gen_lr = gen_lr
         self.dis_lr = dis_lr
+        self.accumulation_steps = accumulation_steps
         
         # Gan setup settings
         self.loss_weights=loss_weights
-        self.VGGLoss = VGGLoss(self.shape_hr)
+        self.VGGLoss = VGGLoss(self.shape_hr, vgg_layer)
         self.gen_loss =  'mse' 
         self.content_loss = self.VGGLoss.content_loss # self.VGGLoss.euclidean_content_loss
         self.adversarial_loss = 'binary_crossentropy'
@@ -98,11 +124,54 @@ class SRGAN():
             self.compile_srgan(self.srgan)
 
 
+    @property
+    def is_chief(self):
+        """Whether this process writes the weights, logs and samples"""
+        return self.cluster is None or self.cluster.is_chief
+
     def save_weights(self, filepath):
         """Save the generator and discriminator networks"""
         self.generator.save_weights("{}_generator_{}X.h5".format(filepath, self.upscaling_factor))
         self.discriminator.save_weights("{}_discriminator_{}X.h5".format(filepath, self.upscaling_factor))
 
+    def state_variables(self):
+        """Named groups of the variables of the training state, weights in the order of Model.get_weights"""
+        return [
+            ('generator', [w for layer in self.generator.layers for w in layer.weights]),
+            ('discriminator', [w for layer in self.discriminator.layers for w in layer.weights]),
+            ('generator_optimizer', self.srgan.optimizer.weights),
+            ('discriminator_optimizer', self.discriminator.optimizer.weights)
+        ]
+
+    def training_state(self):
+        """Weights and optimizer states of both networks as named arrays, read in one session call"""
+        groups = self.state_variables()
+        values = iter(K.batch_get_value([v for _, variables in groups for v in variables]))
+        arrays = {}
+        for name, variables in groups:
+            for i in range(len(variables)):
+                arrays['{}_{}'.format(name, i)] = next(values)
+        return arrays
+
+    def set_training_state(self, arrays):
+        """Restore the arrays of training_state, once the optimizers have built their updates"""
+        K.batch_set_value([
+            (v, arrays['{}_{}'.format(name, i)])
+            for name, variables in self.state_variables() for i, v in enumerate(variables)
+        ])
+
+    def weight_exports(self, filepath, arrays):
+        """The weights files of save_weights, as (path, layers, values) from the arrays of training_state"""
+        exports = []
+        for name, model in [('generator', self.generator), ('discriminator', self.discriminator)]:
+            count = sum(len(layer.weights) for layer in model.layers)
+            exports.append((
+                "{}_{}_{}X.h5".format(filepath, name, self.upscaling_factor),
+                model.layers,
+                [arrays['{}_{}'.format(name, i)] for i in range(count)]
+            ))
+        return exports
+
     def load_weights(self, generator_weights=None, discriminator_weights=None, **kwargs):
         print(">> Loading weights...")
         if generator_weights:
@@ -269,11 +338,108 @@ class SRGAN():
 
 
 
+    def build_fused_step(self, cached_features=False):
+        """
+        One GAN iteration as a single graph call: the generator runs once on the
+        batch and the discriminator and generator are both updated from that forward
+        pass, with the losses, loss weights and optimizers of the compiled models.
+        The discriminator runs once on the real and generated images concatenated, as
+        its train_on_batch does, and the generator's adversarial loss takes the
+        generated half of that pass (so with the batch statistics of both halves).
+        The two updates are simultaneous, the generator does not see the discriminator
+        updated on the same batch. Returns a function of (imgs_lr, imgs_hr[, features_hr]) giving
+        the discriminator [loss, acc] followed by the GAN [loss, Content_loss, Adversarial_loss].
+        """
+        img_lr = K.placeholder(shape=(None,) + self.shape_lr)
+        img_hr = K.placeholder(shape=(None,) + self.shape_hr)
+        features_hr = K.placeholder(ndim=4) if cached_features else None
+        generated_hr = self.generator(img_lr)
+        combined_hr = K.concatenate([img_hr, generated_hr], axis=0)
+        checks = self.discriminator(combined_hr)
+        batch_size = K.shape(img_hr)[0]
+        real_check, fake_check = checks[:batch_size], checks[batch_size:]
+
+        # Discriminator: real and generated images in one batch, as train_on_batch
+        labels = K.concatenate([K.ones_like(real_check), K.zeros_like(fake_check)], axis=0)
+        d_loss = K.mean(K.binary_crossentropy(labels, checks))
+        d_acc = K.mean(K.cast(K.equal(labels, K.round(checks)), K.floatx()))
+
+        # Generator: content and reversed label adversarial loss, as the combined model
+        if cached_features:
+            content_loss = self.VGGLoss.cached_content_loss(features_hr, generated_hr)
+        else:
+            content_loss = self.content_loss(img_hr, generated_hr)
+        adversarial_loss = K.mean(K.binary_crossentropy(K.ones_like(fake_check), fake_check))
+        g_loss = self.loss_weights[0] * content_loss + self.loss_weights[1] * adversarial_loss
+
+        # Each loss only updates its own network (the discriminator model is frozen, not its layers)
+        d_weights = [w for layer in self.discriminator.layers for w in layer.trainable_weights]
+        updates = self.discriminator.optimizer.get_updates(loss=d_loss, params=d_weights)
+        updates += self.srgan.optimizer.get_updates(loss=g_loss, params=self.generator.trainable_weights)
+        # Batch normalization statistics, which a frozen model does not return
+        updates += self.generator.get_updates_for(img_lr)
+        trainable, self.discriminator.trainable = self.discriminator.trainable, True
+        updates += self.discriminator.get_updates_for(combined_hr)
+        self.discriminator.trainable = trainable
+
+        inputs = [img_lr, img_hr] + ([features_hr] if cached_features else [])
+        step = K.function(
+            inputs + [K.learning_phase()],
+            [d_loss, d_acc, g_loss, content_loss, adversarial_loss],
+            updates=updates
+        )
+        return lambda *batch: step(list(batch) + [1])
+
+    def build_validator(self, validation_data, steps, threads=2):
+        """Copy of the generator in its own graph and session of a few threads, evaluating snapshots in the background"""
+        config = session_config(self.precision)
+        config.intra_op_parallelism_threads = threads
+        config.inter_op_parallelism_threads = 1
+        session = tf.Session(graph=tf.Graph(), config=config)
+        with session.graph.as_default(), session.as_default():
+            model = self.build_generator()
+            model.compile(loss=self.gen_loss, optimizer='adam', metrics=[psnr])
+        return BackgroundValidator(model, session, validation_data, steps)
+
+    def build_degrader(self, media_type='i'):
+        """Batch degradation matching the loader: blur + bicubic for images, random kernel for videos"""
+        return BatchDegrader(
+            self.height_hr, self.width_hr,
+            self.channels,
+            self.upscaling_factor,
+            blur=media_type != 'v',
+            methods=['nearest', 'bilinear', 'bicubic', 'area'] if media_type == 'v' else ['bicubic']
+        )
+
+    @staticmethod
+    def prefetch_size(loader, workers, max_queue_size, max_queue_bytes=None, shared_memory=False):
+        """Batches the enqueuer may hold, at most max_queue_size and within max_queue_bytes"""
+        batch_bytes = loader.batch_nbytes()
+        if max_queue_bytes:
+            fits = int(max_queue_bytes // batch_bytes)
+            # Shared memory slots are allocated for the queue plus one per worker
+            if shared_memory:
+                fits -= workers
+            max_queue_size = max(1, min(max_queue_size or fits, fits))
+        print(">> Prefetch queue of {} batches of {:.1f}MB, up to {:.1f}MB".format(
+            max_queue_size, batch_bytes / 2.**20, max_queue_size * batch_bytes / 2.**20))
+        return max_queue_size
+
+    def build_optimizer(self, lr):
+        """Adam, accumulating the gradients of accumulation_steps micro-batches if more than one"""
+        optimizer = Adam(lr=lr, beta_1=0.9)
+        if self.accumulation_steps > 1:
+            optimizer = AccumulatedOptimizer(optimizer, self.accumulation_steps)
+        # Gradients averaged over the workers, for each micro-batch when accumulating
+        if self.cluster is not None:
+            optimizer = self.cluster.all_reduce_gradients(optimizer)
+        return optimizer
+
     def compile_generator(self, model):
         """Compile the generator with appropriate optimizer"""
         model.compile(
             loss=self.gen_loss,
-            optimizer=Adam(lr=self.gen_lr, beta_1=0.9),
+            optimizer=self.build_optimizer(self.gen_lr),
             metrics=[psnr]
         )
 
@@ -281,17 +447,17 @@ class SRGAN():
         """Compile the generator with appropriate optimizer"""
         model.compile(
             loss=self.adversarial_loss,
-            optimizer=Adam(lr=self.dis_lr, beta_1=0.9),
+            optimizer=self.build_optimizer(self.dis_lr),
             metrics=['accuracy']
         )
 
 
-    def compile_srgan(self, model):
-        """Compile the GAN with appropriate optimizer"""
+    def compile_srgan(self, model, cached_features=False):
+        """Compile the GAN with appropriate optimizer, the content target being VGG features if cached_features"""
         model.compile(
-            loss=[self.content_loss,self.adversarial_loss],
+            loss=[self.VGGLoss.cached_content_loss if cached_features else self.content_loss,self.adversarial_loss],
             loss_weights=self.loss_weights,
-            optimizer=Adam(lr=self.gen_lr, beta_1=0.9)
+            optimizer=self.build_optimizer(self.gen_lr)
         )
 
     def train_generator(self,
@@ -308,12 +474,31 @@ class SRGAN():
         print_frequency=None,
         log_weight_path='./model/', 
         log_tensorboard_path='./logs/',
-        log_tensorboard_update_freq=None,
+        log_tensorboard_update_freq=10,
         log_test_path="./test/",
-        media_type='i'
+        media_type='i',
+        keyframes_only=False,
+        frames_per_video=1,
+        batch_degradation=False,
+        decode='full',
+        shared_memory=False,
+        sampler=None,
+        tf_data=False,
+        refresh_manifest=False,
+        loader_telemetry=False,
+        image_cache_mb=0,
+        texture_floor=None,
+        max_queue_bytes=None,
+        fixed_validation=0,
+        validation_seed=0,
+        fused_step=False,
+        vgg_feature_cache=False
     ):
         """Trains the generator part of the network with MSE loss"""
 
+        # Tar streams live in their worker process, the keras enqueuer would start new ones at each epoch
+        if media_type == 't' and workers and not tf_data:
+            shared_memory = True
 
         # Create data loaders
         train_loader = DataLoader(
@@ -323,7 +508,18 @@ class SRGAN():
             crops_per_image,
             media_type,
             self.channels,
-            self.colorspace
+            self.colorspace,
+            keyframes_only=keyframes_only,
+            frames_per_video=frames_per_video,
+            hr_only=batch_degradation,
+            decode=decode,
+            scaled=not shared_memory,
+            sampler=sampler,
+            refresh_manifest=refresh_manifest,
+            stats=LoaderStats() if loader_telemetry else None,
+            streams=workers or 1,
+            cache_bytes=image_cache_mb << 20,
+            texture_floor=texture_floor
         )
 
         
@@ -336,8 +532,16 @@ class SRGAN():
                 crops_per_image,
                 media_type,
                 self.channels,
-                self.colorspace
+                self.colorspace,
+                keyframes_only=keyframes_only,
+                frames_per_video=frames_per_video,
+                refresh_manifest=refresh_manifest,
+                scaled=not fixed_validation
         )
+            # Crops drawn once and evaluated in full
+            if fixed_validation:
+                validation_loader = FixedValidationSet(validation_loader, fixed_validation, validation_seed, writer=self.is_chief)
+                steps_per_validation = len(validation_loader)
 
         test_loader = None
         if datapath_test is not None:
@@ -354,7 +558,7 @@ class SRGAN():
         
         # Callback: tensorboard
         callbacks = []
-        if log_tensorboard_path:
+        if log_tensorboard_path and self.is_chief:
             tensorboard = TensorBoard(
                 log_dir=os.path.join(log_tensorboard_path, modelname),
                 histogram_freq=0,
@@ -376,13 +580,14 @@ class SRGAN():
         callbacks.append(earlystopping)
         
         # Callback: save weights after each epoch
-        modelcheckpoint = ModelCheckpoint(
-            os.path.join(log_weight_path, modelname + '_{}X.h5'.format(self.upscaling_factor)), 
-            monitor='val_loss', 
-            save_best_only=True, 
-            save_weights_only=True
-        )
-        callbacks.append(modelcheckpoint)
+        if self.is_chief:
+            modelcheckpoint = ModelCheckpoint(
+                os.path.join(log_weight_path, modelname + '_{}X.h5'.format(self.upscaling_factor)), 
+                monitor='val_loss', 
+                save_best_only=True, 
+                save_weights_only=True
+            )
+            callbacks.append(modelcheckpoint)
 
         # Callback: Reduce lr when a monitored quantity has stopped improving
         reduce_lr = ReduceLROnPlateau(monitor='val_loss', factor=0.5,
@@ -398,10 +603,20 @@ class SRGAN():
             return lr
         lr_scheduler = LearningRateScheduler(lr_scheduler, verbose=1)
         callbacks.append(lr_scheduler)
+
+        # Callback: save the position of the data order
+        if sampler is not None and self.is_chief:
+            samplercheckpoint = LambdaCallback(
+                on_epoch_end=lambda epoch, logs: sampler.save(
+                    os.path.join(log_weight_path, modelname + '_sampler.json'),
+                    sampler.step + (epoch+1)*steps_per_epoch
+                )
+            )
+            callbacks.append(samplercheckpoint)
  
         
          # Callback: test images plotting
-        if datapath_test is not None:
+        if datapath_test is not None and self.is_chief:
             testplotting = LambdaCallback(
                 on_epoch_end=lambda epoch, logs: None if ((epoch+1) % print_frequency != 0 ) else plot_test_images(
                     self.generator,
@@ -412,16 +627,46 @@ class SRGAN():
                     name=modelname,
                     channels=self.channels,
                     colorspace=self.colorspace))
-        callbacks.append(testplotting)
+            callbacks.append(testplotting)
 
         # Use several workers on CPU for preparing batches
-        enqueuer = OrderedEnqueuer(
-            train_loader,
-            use_multiprocessing=True
-        )
-        enqueuer.start(workers=workers, max_queue_size=max_queue_size)
-        output_generator = enqueuer.get()
+        enqueuer = None
+        if not tf_data:
+            max_queue_size = self.prefetch_size(train_loader, workers, max_queue_size, max_queue_bytes, shared_memory)
+        if tf_data:
+            output_generator = DataLoader.iterate(train_loader.as_dataset())
+        else:
+            if shared_memory:
+                enqueuer = SharedMemoryEnqueuer(train_loader)
+            else:
+                enqueuer = OrderedEnqueuer(
+                    train_loader,
+                    use_multiprocessing=True
+                )
+            enqueuer.start(workers=workers, max_queue_size=max_queue_size)
+            output_generator = enqueuer.get()
+            if shared_memory:
+                print(">> Shared memory slots: {:.1f}MB".format(enqueuer.nbytes() / 2.**20))
+
+        # Build the LR batches from the HR crops on this side
+        if batch_degradation:
+            output_generator = self.build_degrader(media_type).flow(output_generator)
+
+        # Callback: loader stage times, ready batches and input wait
+        if loader_telemetry and log_tensorboard_path and self.is_chief:
+            telemetry = LoaderTelemetry(
+                os.path.join(log_tensorboard_path, modelname),
+                train_loader.stats, enqueuer, max_queue_size,
+                update_freq=log_tensorboard_update_freq,
+                batch_bytes=train_loader.batch_nbytes()
+            )
+            callbacks.append(telemetry)
+            # Timed in the keras prefetch thread, which only waits for the loader when training is input-bound
+            output_generator = telemetry.timed(output_generator)
 
+        # Callback: workers on the chief's weights before validation and on its decisions after the other callbacks
+        if self.cluster is not None:
+            callbacks.append(ChiefSync(self.cluster, self.generator, steps_per_epoch))
                             
         # Fit the model
         self.generator.fit_generator(
@@ -432,9 +677,16 @@ class SRGAN():
             validation_steps=steps_per_validation,
             callbacks=callbacks,
             use_multiprocessing=False, #workers>1 because single gpu
-            workers=workers
+            workers=workers,
+            # The enqueuer already prefetches, keep the keras queue within the budget
+            max_queue_size=2 if max_queue_bytes else 10
         )
 
+        # Release the workers and the image cache of the stage
+        if enqueuer is not None:
+            enqueuer.stop()
+        train_loader.close()
+
     def train_srgan(self, 
         epochs=None, batch_size=16, 
         modelname=None, 
@@ -452,7 +704,27 @@ class SRGAN():
         log_tensorboard_update_freq=10,
         log_test_frequency=500,
         log_test_path="./images/samples/", 
-        media_type='i'        
+        media_type='i',
+        keyframes_only=False,
+        frames_per_video=1,
+        batch_degradation=False,
+        decode='full',
+        shared_memory=False,
+        sampler=None,
+        tf_data=False,
+        refresh_manifest=False,
+        loader_telemetry=False,
+        image_cache_mb=0,
+        texture_floor=None,
+        max_queue_bytes=None,
+        fixed_validation=0,
+        validation_seed=0,
+        fused_step=False,
+        vgg_feature_cache=False,
+        checkpoint_path=None,
+        checkpoints_to_keep=3,
+        resume=False,
+        validation_threads=2
     ):
         """Train the SRGAN network
 
@@ -466,10 +738,53 @@ class SRGAN():
         :param int log_test_frequency: how often (in epochs) should testing & validation be performed
         :param str log_test_path: where should test results be saved
         :param str log_tensorboard_path: where should tensorflow logs be sent
+        :param str media_type: 'i' for images, 'v' for videos, 'p' for patch shards
+        :param bool keyframes_only: in video mode, sample only keyframes
+        :param int frames_per_video: in video mode, frames read from each video in one pass
+        :param bool batch_degradation: workers return only HR crops, degraded and augmented in batch with TF ops
+        :param str decode: JPEG decoding of training crops, 'full', 'region' or 'draft'
+        :param bool shared_memory: workers send uint8 batches through shared-memory slots instead of pickling them
+        :param ShardedSampler sampler: deterministic, sharded order of the training data, saved with the weights
+        :param bool tf_data: build the training batches with a tf.data graph instead of enqueuer workers
+        :param bool refresh_manifest: walk the dataset folders again instead of trusting their cached manifests
+        :param bool loader_telemetry: log loader stage times and enqueuer queue occupancy to tensorboard
+        :param int image_cache_mb: memory budget in MB of decoded training images shared by the loader workers, 0 to disable
+        :param float texture_floor: draw image crops by texture, with this share of uniform positions (1 is uniform), None to disable
+        :param int max_queue_bytes: memory budget of the prefetched batches, which limits max_queue_size. None for no limit
+        :param int fixed_validation: number of validation crops drawn once, stored with the validation data and evaluated in full each time, 0 for new random crops
+        :param int validation_seed: seed of the validation crops
+        :param bool fused_step: run the generator once per iteration and update both networks from that forward pass in one graph call
+        :param bool vgg_feature_cache: in patch mode, read the VGG features of the HR patches from the cache built by build_features.py instead of computing them
+        :param str checkpoint_path: folder of the full training state checkpoints, <log_weight_path>/<modelname>_checkpoints if None
+        :param int checkpoints_to_keep: most recent checkpoints kept, besides the one with the best validation PSNR
+        :param bool resume: resume the weights, optimizer states, iteration and data position of the last checkpoint
+        :param int validation_threads: CPU threads validating weight snapshots in the background, 0 to validate in the loop
         """
 
         
         
+        if vgg_feature_cache and (media_type != 'p' or shared_memory or batch_degradation or tf_data):
+            raise ValueError('The VGG feature cache needs patch shards (media_type p) loaded by the default enqueuer')
+        # Tar streams live in their worker process, the keras enqueuer would start new ones at each epoch
+        if media_type == 't' and workers and not tf_data:
+            shared_memory = True
+
+        # Resume the loop, and the data order before the loader is built, from the last checkpoint
+        if checkpoint_path is None:
+            checkpoint_path = os.path.join(log_weight_path, modelname + '_checkpoints')
+        last_epoch = int(epochs) + first_epoch
+        resumed = None
+        if resume:
+            latest = latest_checkpoint(checkpoint_path)
+            if latest is None:
+                print(">> No checkpoint to resume from in", checkpoint_path)
+            else:
+                print(">> Resuming from", latest)
+                resumed = CheckpointManager.load(latest)
+                first_epoch = resumed[1]['epoch'] + 1
+                if sampler is not None and resumed[1]['sampler_step'] is not None:
+                    sampler.step = resumed[1]['sampler_step']
+
          # Create data loaders
         train_loader = DataLoader(
             datapath_train, batch_size,
@@ -478,7 +793,19 @@ class SRGAN():
             crops_per_image,
             media_type,
             self.channels,
-            self.colorspace
+            self.colorspace,
+            keyframes_only=keyframes_only,
+            frames_per_video=frames_per_video,
+            hr_only=batch_degradation,
+            decode=decode,
+            scaled=not shared_memory,
+            sampler=sampler,
+            refresh_manifest=refresh_manifest,
+            stats=LoaderStats() if loader_telemetry else None,
+            streams=workers or 1,
+            cache_bytes=image_cache_mb << 20,
+            texture_floor=texture_floor,
+            vgg_features=(self.VGGLoss.layer, self.VGGLoss.preprocessing) if vgg_feature_cache else None
         )
 
         # Validation data loader
@@ -491,8 +818,18 @@ class SRGAN():
                 crops_per_image,
                 media_type,
                 self.channels,
-                self.colorspace
+                self.colorspace,
+                keyframes_only=keyframes_only,
+                frames_per_video=frames_per_video,
+                refresh_manifest=refresh_manifest,
+                scaled=not fixed_validation,
+                # Own random state, validation in the background must not move the one saved in the checkpoints
+                rng=np.random.RandomState(validation_seed)
         )
+            # Crops drawn once and evaluated in full
+            if fixed_validation:
+                validation_loader = FixedValidationSet(validation_loader, fixed_validation, validation_seed, writer=self.is_chief)
+                steps_per_validation = len(validation_loader)
 
         test_loader = None
         if datapath_test is not None:
@@ -507,16 +844,50 @@ class SRGAN():
         )
     
         # Use several workers on CPU for preparing batches
-        enqueuer = OrderedEnqueuer(
-            train_loader,
-            use_multiprocessing=True,
-            shuffle=True
-        )
-        enqueuer.start(workers=workers, max_queue_size=max_queue_size)
-        output_generator = enqueuer.get()
+        enqueuer = None
+        if not tf_data:
+            max_queue_size = self.prefetch_size(train_loader, workers, max_queue_size, max_queue_bytes, shared_memory)
+        if tf_data:
+            output_generator = DataLoader.iterate(train_loader.as_dataset())
+        else:
+            if shared_memory:
+                enqueuer = SharedMemoryEnqueuer(train_loader, shuffle=sampler is None)
+            else:
+                enqueuer = OrderedEnqueuer(
+                    train_loader,
+                    use_multiprocessing=True,
+                    shuffle=sampler is None
+                )
+            enqueuer.start(workers=workers, max_queue_size=max_queue_size)
+            output_generator = enqueuer.get()
+            if shared_memory:
+                print(">> Shared memory slots: {:.1f}MB".format(enqueuer.nbytes() / 2.**20))
+
+        # Build the LR batches from the HR crops on this side
+        if batch_degradation:
+            output_generator = self.build_degrader(media_type).flow(output_generator)
+
+        # Callback: loader stage times, ready batches and input wait
+        telemetry = None
+        if loader_telemetry and log_tensorboard_path and self.is_chief:
+            telemetry = LoaderTelemetry(
+                os.path.join(log_tensorboard_path, modelname),
+                train_loader.stats, enqueuer, max_queue_size,
+                update_freq=log_tensorboard_update_freq,
+                batch_bytes=train_loader.batch_nbytes()
+            )
+
+        def next_batch():
+            """Next training batch, timing the wait for the loader"""
+            start = timer()
+            batch = next(output_generator)
+            if telemetry is not None:
+                telemetry.input_wait(timer() - start)
+            return batch
         
         # Callback: tensorboard
-        if log_tensorboard_path:
+        tensorboard = None
+        if log_tensorboard_path and self.is_chief:
             tensorboard = TensorBoard(
                 log_dir=os.path.join(log_tensorboard_path, modelname),
                 histogram_freq=0,
@@ -547,52 +918,104 @@ class SRGAN():
         fake = np.zeros(disciminator_output_shape) 
                
 
+        # Content loss against the cached VGG features of the HR patches
+        if vgg_feature_cache:
+            self.discriminator.trainable = False
+            self.compile_srgan(self.srgan, cached_features=True)
+
+        # Fused iteration graph, instead of predict + two train_on_batch
+        fused = self.build_fused_step(vgg_feature_cache) if fused_step else None
+
+        # Optimizer states only exist once the training functions are built
+        if resumed is not None:
+            if not fused_step:
+                self.discriminator._make_train_function()
+                self.srgan._make_train_function()
+            arrays, state = resumed
+            self.set_training_state(arrays)
+            np.random.set_state(('MT19937', arrays['rng_keys']) + tuple(state['rng']))
+
+        # Checkpoints written in the background
+        checkpoints = None
+        if log_weight_frequency and self.is_chief:
+            checkpoints = CheckpointManager(checkpoint_path, checkpoints_to_keep)
+
+        # Validation of weight snapshots on its own thread, only by the chief
+        validator = None
+        if datapath_validation and validation_threads and self.is_chief:
+            validator = self.build_validator(validation_loader, steps_per_validation, validation_threads)
+
+        def log_validation(validated_epoch, validation_losses):
+            print(">> Validation Losses (iteration {}): {}".format(
+                validated_epoch,
+                ", ".join(["{}={:.4f}".format(k, v) for k, v in zip(self.generator.metrics_names, validation_losses)])
+            ))
+            # PSNR is the only metric of the generator
+            if checkpoints is not None:
+                checkpoints.report(validated_epoch, validation_losses[-1])
+
+        # Workers start from the chief's weights and take them again before each save
+        sync = None
+        if self.cluster is not None:
+            sync = self.cluster.broadcast(self.generator.weights + self.discriminator.weights)
+            sync()
+
         # Each epoch == "update iteration" as defined in the paper        
         print_losses = {"GAN": [], "D": []}
         start_epoch = datetime.datetime.now()
         
-        # Random images to go through
-        idxs = np.random.randint(0, len(train_loader), epochs)        
-        
         # Loop through epochs / iterations
-        for epoch in range(first_epoch, int(epochs)+first_epoch):
+        for epoch in range(first_epoch, last_epoch):
+            validation_psnr = None
 
             # Start epoch time
             if epoch % (print_frequency + 1) == 0:
                 start_epoch = datetime.datetime.now()            
 
-            # Train discriminator 
-            self.discriminator.trainable = True
-            #real = np.ones(disciminator_output_shape) - np.random.random_sample(disciminator_output_shape)*0.05
-            #fake = np.random.random_sample(disciminator_output_shape)*0.05  
-            labels = np.concatenate([real, fake])
-            imgs_lr, imgs_hr = next(output_generator)
-            generated_hr = self.generator.predict(imgs_lr)
-            combined_images = np.concatenate([imgs_hr, generated_hr])
-            discriminator_loss = self.discriminator.train_on_batch(combined_images, labels)
-            #real_loss = self.discriminator.train_on_batch(imgs_hr, real)
-            #print("Real: ",real_loss)
-            #fake_loss = self.discriminator.train_on_batch(generated_hr, fake)
-            #print("Fake: ",fake_loss)
-            #discriminator_loss = 0.5 * np.add(real_loss, fake_loss)
+            # One generator forward updating both networks
+            if fused_step:
+                outs = fused(*next_batch())
+                discriminator_loss, gan_loss = outs[:2], outs[2:]
+            else:
+                # Train discriminator 
+                self.discriminator.trainable = True
+                #real = np.ones(disciminator_output_shape) - np.random.random_sample(disciminator_output_shape)*0.05
+                #fake = np.random.random_sample(disciminator_output_shape)*0.05  
+                labels = np.concatenate([real, fake])
+                imgs_lr, imgs_hr = next_batch()[:2]
+                generated_hr = self.generator.predict(imgs_lr)
+                combined_images = np.concatenate([imgs_hr, generated_hr])
+                discriminator_loss = self.discriminator.train_on_batch(combined_images, labels)
+                #real_loss = self.discriminator.train_on_batch(imgs_hr, real)
+                #print("Real: ",real_loss)
+                #fake_loss = self.discriminator.train_on_batch(generated_hr, fake)
+                #print("Fake: ",fake_loss)
+                #discriminator_loss = 0.5 * np.add(real_loss, fake_loss)
             
 
-            # Train generator
-            self.discriminator.trainable = False
-            #real = np.ones(disciminator_output_shape) - np.random.random_sample(disciminator_output_shape)*0.05  
-            #imgs_lr, imgs_hr = next(output_generator)
-            #gan_loss = self.srgan.train_on_batch(imgs_lr, [imgs_hr,real])
+                # Train generator
+                self.discriminator.trainable = False
+                #real = np.ones(disciminator_output_shape) - np.random.random_sample(disciminator_output_shape)*0.05  
+                #imgs_lr, imgs_hr = next(output_generator)
+                #gan_loss = self.srgan.train_on_batch(imgs_lr, [imgs_hr,real])
 
-            """ real = np.ones(disciminator_output_shape) - np.random.random_sample(disciminator_output_shape)*0.2 """  
+                """ real = np.ones(disciminator_output_shape) - np.random.random_sample(disciminator_output_shape)*0.2 """  
             
-            #for _ in tqdm(range(1),ncols=1,desc=">> Training generator:"):
-            imgs_lr, imgs_hr = next(output_generator)
-            gan_loss = self.srgan.train_on_batch(imgs_lr, [imgs_hr,real])
+                #for _ in tqdm(range(1),ncols=1,desc=">> Training generator:"):
+                batch = next_batch()
+                # HR images or their cached VGG features as content target
+                gan_loss = self.srgan.train_on_batch(batch[0], [batch[-1],real])
 
      
             # Callbacks
             logs = named_logs(self.srgan, gan_loss)
-            tensorboard.on_epoch_end(epoch, logs)
+            if tensorboard is not None:
+                tensorboard.on_epoch_end(epoch, logs)
+            if telemetry is not None:
+                telemetry.on_batch_end(epoch)
+            if validator is not None:
+                for validated_epoch, validation_losses in validator.results():
+                    log_validation(validated_epoch, validation_losses)
 
             # Save losses            
             print_losses['GAN'].append(gan_loss)
@@ -603,34 +1026,70 @@ class SRGAN():
                 g_avg_loss = np.array(print_losses['GAN']).mean(axis=0)
                 d_avg_loss = np.array(print_losses['D']).mean(axis=0)
                 print("\nEpoch {}/{} | Time: {}s\n>> GAN: {}\n>> Discriminator: {}".format(
-                    epoch, epochs+first_epoch,
+                    epoch, last_epoch,
                     (datetime.datetime.now() - start_epoch).seconds,
                     ", ".join(["{}={:.4f}".format(k, v) for k, v in zip(self.srgan.metrics_names, g_avg_loss)]),
                     ", ".join(["{}={:.4f}".format(k, v) for k, v in zip(self.discriminator.metrics_names, d_avg_loss)])
                 ))
                 print_losses = {"GAN": [], "D": []}
 
-                # Run validation inference if specified
-                if datapath_validation:
+                # Run validation inference if specified, on a snapshot of the weights in the background
+                if datapath_validation and validation_threads:
+                    if validator is not None:
+                        validator.submit(epoch, self.generator.get_weights())
+                elif datapath_validation:
                     validation_losses = self.generator.evaluate_generator(
                         validation_loader,
                         steps=steps_per_validation,
-                        use_multiprocessing=workers>1,
+                        use_multiprocessing=workers>1 and not fixed_validation,
                         workers=workers
                     )
                     print(">> Validation Losses: {}".format(
                         ", ".join(["{}={:.4f}".format(k, v) for k, v in zip(self.generator.metrics_names, validation_losses)])
                     ))                
+                    # PSNR is the only metric of the generator
+                    validation_psnr = validation_losses[-1]
 
             # If test images are supplied, run model on them and save to log_test_path
-            if datapath_test and epoch % log_test_frequency == 0:
+            if datapath_test and epoch % log_test_frequency == 0 and self.is_chief:
                 plot_test_images(self.generator, test_loader, datapath_test, log_test_path, epoch, modelname,
                 channels = self.channels,colorspace=self.colorspace)
 
             # Check if we should save the network weights
             if log_weight_frequency and epoch % log_weight_frequency == 0:
-                # Save the network weights
-                self.save_weights(os.path.join(log_weight_path, modelname))
+                # Every worker takes part in the broadcast, only the chief saves
+                if sync is not None:
+                    sync()
+                if not self.is_chief:
+                    continue
+                # Two batches are drawn per iteration, one by the fused step
+                sampler_step = None
+                if sampler is not None:
+                    sampler_step = sampler.step + (1 if fused_step else 2)*(epoch - first_epoch + 1)
+                    sampler.save(os.path.join(log_weight_path, modelname + '_sampler.json'), sampler_step)
+
+                # Weights, optimizer states and loop state copied here, written in the background
+                arrays = self.training_state()
+                rng = np.random.get_state()
+                arrays['rng_keys'] = rng[1]
+                state = {'epoch': epoch, 'sampler_step': sampler_step, 'rng': list(rng[2:])}
+                checkpoints.save(
+                    epoch, arrays, state, psnr=validation_psnr,
+                    exports=self.weight_exports(os.path.join(log_weight_path, modelname), arrays)
+                )
+
+        # Validate the last snapshot, then write the last checkpoint
+        if validator is not None:
+            validator.close()
+            for validated_epoch, validation_losses in validator.results():
+                log_validation(validated_epoch, validation_losses)
+        if checkpoints is not None:
+            checkpoints.close()
+
+        # Release the workers and the image cache of the stage
+        if enqueuer is not None:
+            enqueuer.stop()
+        train_loader.close()
 
     def predict(self,
             lr_path = None,
@@ -0,0 +1,91 @@
+import os
+import json
+import tarfile
+import numpy as np
+
+
+TAR_SHARDS_META = 'tarshards.json'
+
+
+def write_tar_shards(paths, datapath, output_path, shard_bytes=1 << 30, seed=None):
+    """
+    Pack dataset files into tar shards of about shard_bytes each, in random order,
+    so that each shard is a sample of the whole dataset and can be read sequentially.
+
+    :param list paths: files to pack
+    :param string datapath: dataset folder, member names are relative to it
+    :param string output_path: folder where shards are written
+    :param int shard_bytes: approximate size of each shard
+    :param int seed: seed of the packing order
+    """
+    if not os.path.isdir(output_path):
+        os.makedirs(output_path)
+    paths = list(paths)
+    np.random.RandomState(seed).shuffle(paths)
+
+    shards, tar = [], None
+    for path in paths:
+        if tar is None or shards[-1]['bytes'] >= shard_bytes:
+            if tar is not None:
+                tar.close()
+            name = 'shard_{:05d}.tar'.format(len(shards))
+            tar = tarfile.open(os.path.join(output_path, name), 'w')
+            shards.append({'path': name, 'count': 0, 'bytes': 0})
+        tar.add(path, arcname=os.path.relpath(path, datapath))
+        shards[-1]['count'] += 1
+        shards[-1]['bytes'] += os.path.getsize(path)
+    if tar is not None:
+        tar.close()
+
+    meta = {'seed': seed, 'shards': shards}
+    with open(os.path.join(output_path, TAR_SHARDS_META), 'w') as f:
+        json.dump(meta, f, indent=4)
+    print(">> Written {} files in {} shards".format(len(paths), len(shards)))
+    return meta
+
+
+class TarShardStream(object):
+    """
+    Endless stream of (name, bytes) read sequentially from tar shards, in a new
+    shard order each pass, through a shuffle buffer bounded in files and in bytes.
+    Each file is read whole, so a stream holds at most buffer_bytes plus the
+    largest file in memory. Files larger than buffer_bytes (e.g. long videos) go
+    through unshuffled.
+    """
+
+    def __init__(self, shard_paths, shuffle_buffer=256, seed=None, buffer_bytes=256 << 20):
+        """
+        :param list shard_paths: tar shards to read
+        :param int shuffle_buffer: files kept in memory to shuffle the stream
+        :param int seed: seed of the shard order and of the shuffle buffer
+        :param int buffer_bytes: memory budget of the files kept in the shuffle buffer
+        """
+        self.shard_paths = list(shard_paths)
+        self.shuffle_buffer = shuffle_buffer
+        self.buffer_bytes = buffer_bytes
+        self.rng = np.random.RandomState(seed)
+
+    def files(self):
+        while True:
+            for i in self.rng.permutation(len(self.shard_paths)):
+                # Streaming mode: only sequential reads
+                with tarfile.open(self.shard_paths[i], 'r|') as tar:
+                    for member in tar:
+                        if member.isfile():
+                            yield member.name, tar.extractfile(member).read()
+
+    def __iter__(self):
+        buffer, nbytes = [], 0
+        for item in self.files():
+            if len(item[1]) > self.buffer_bytes:
+                yield item
+                continue
+            buffer.append(item)
+            nbytes += len(item[1])
+            # Random files out until both bounds hold
+            while len(buffer) > self.shuffle_buffer or nbytes > self.buffer_bytes:
+                i = self.rng.randint(len(buffer))
+                buffer[i], buffer[-1] = buffer[-1], buffer[i]
+                name, data = buffer.pop()
+                nbytes -= len(data)
+                yield name, data
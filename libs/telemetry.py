@@ -0,0 +1,134 @@
+import multiprocessing as mp
+import numpy as np
+import tensorflow as tf
+from contextlib import contextmanager
+from timeit import default_timer as timer
+from keras.callbacks import Callback
+
+
+class LoaderStats(object):
+    """
+    Time spent in each stage of the DataLoader, accumulated in shared memory so
+    that forked enqueuer workers report to the training process.
+    """
+
+    STAGES = ('decode', 'crop', 'degradation', 'scaling', 'assembly')
+
+    def __init__(self):
+        self.totals = mp.RawArray('d', len(self.STAGES))
+        self.batches = mp.RawValue('l', 0)
+        self.lock = mp.Lock()
+
+    @contextmanager
+    def time(self, stage):
+        start = timer()
+        yield
+        elapsed = timer() - start
+        with self.lock:
+            self.totals[self.STAGES.index(stage)] += elapsed
+
+    def batch_done(self):
+        with self.lock:
+            self.batches.value += 1
+
+    def collect(self):
+        """Mean ms per batch of each stage since the last call"""
+        with self.lock:
+            totals, batches = list(self.totals), self.batches.value
+            for i in range(len(self.STAGES)):
+                self.totals[i] = 0.
+            self.batches.value = 0
+        if not batches:
+            return {}
+        return {stage: 1000. * total / batches for stage, total in zip(self.STAGES, totals)}
+
+
+@contextmanager
+def no_timing():
+    yield
+
+
+class LoaderTelemetry(Callback):
+    """
+    Writes the loader stage times, the batches ready in the enqueuer and the time
+    waited for them to TensorBoard. Few ready batches and long waits mean training
+    is input-bound, a full queue compute-bound.
+    """
+
+    def __init__(self, log_dir, stats=None, enqueuer=None, max_queue_size=None, update_freq=10, batch_bytes=None):
+        """
+        :param str log_dir: TensorBoard log directory
+        :param LoaderStats stats: stage times shared with the loader workers
+        :param enqueuer: OrderedEnqueuer or SharedMemoryEnqueuer feeding the training
+        :param int max_queue_size: enqueuer queue size, to log the ready batches as a fraction
+        :param int update_freq: batches between two writes
+        :param int batch_bytes: bytes of a queued batch, to log the queue memory
+        """
+        super(LoaderTelemetry, self).__init__()
+        self.writer = tf.summary.FileWriter(log_dir)
+        self.stats = stats
+        self.enqueuer = enqueuer
+        self.max_queue_size = max_queue_size
+        self.update_freq = update_freq
+        self.batch_bytes = batch_bytes
+        self.depths, self.waits = [], []
+        self.step = 0
+
+    def queue_depth(self):
+        """
+        Batches ready to be taken: the filled slots of a SharedMemoryEnqueuer, or the
+        completed futures of an OrderedEnqueuer, whose queue is refilled with pending
+        ones as soon as one is taken and so always looks full
+        """
+        ready = getattr(self.enqueuer, 'ready', None)
+        if ready is not None:
+            try:
+                return ready.qsize()
+            except NotImplementedError:
+                return None
+        queue = getattr(self.enqueuer, 'queue', None)
+        if queue is None:
+            return None
+        return sum(f.ready() for f in list(queue.queue))
+
+    def input_wait(self, seconds):
+        """Time the training loop waited for its batch"""
+        self.waits.append(seconds)
+
+    def timed(self, generator):
+        """The batches of a generator, recording the time waited for each"""
+        while True:
+            start = timer()
+            batch = next(generator)
+            self.input_wait(timer() - start)
+            yield batch
+
+    def on_batch_end(self, batch, logs=None):
+        depth = self.queue_depth()
+        if depth is not None:
+            self.depths.append(depth)
+        self.step += 1
+        if self.step % self.update_freq == 0:
+            self.write()
+
+    def write(self):
+        values = {}
+        if self.depths:
+            values['loader/queue_depth'] = np.mean(self.depths)
+            values['loader/queue_depth_min'] = np.min(self.depths)
+            if self.max_queue_size:
+                values['loader/queue_occupancy'] = np.mean(self.depths) / float(self.max_queue_size)
+            if self.batch_bytes:
+                values['loader/queue_mb'] = np.mean(self.depths) * self.batch_bytes / 2.**20
+        if self.waits:
+            values['loader/input_wait_ms'] = 1000. * np.mean(self.waits)
+        if self.stats is not None:
+            for stage, ms in self.stats.collect().items():
+                values['loader/{}_ms'.format(stage)] = ms
+        summary = tf.Summary(value=[tf.Summary.Value(tag=tag, simple_value=float(v)) for tag, v in values.items()])
+        self.writer.add_summary(summary, self.step)
+        self.writer.flush()
+        self.depths, self.waits = [], []
+
+    def on_train_end(self, logs=None):
+        self.writer.close()
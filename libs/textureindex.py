@@ -0,0 +1,137 @@
+import os
+import math
+import multiprocessing as mp
+import numpy as np
+import cv2
+from PIL import Image
+
+
+TEXTURE_INDEX = '.texture.npz'
+
+
+def texture_scores(img, cell=32):
+    """Mean gradient energy of each cell x cell block of a uint8 HxWx1 luma image"""
+    grey = img[:,:,0].astype(np.float32)
+    gx = cv2.Sobel(grey, cv2.CV_32F, 1, 0)
+    gy = cv2.Sobel(grey, cv2.CV_32F, 0, 1)
+    energy = gx * gx + gy * gy
+    gh, gw = grey.shape[0] // cell, grey.shape[1] // cell
+    return energy[:gh*cell, :gw*cell].reshape(gh, cell, gw, cell).mean(axis=(1, 3))
+
+
+def _score_file(args):
+    path, cell = args
+    try:
+        img = Image.open(path)
+        # Luma only, JPEGs are decoded without chroma
+        img.draft('L', img.size)
+        img = np.array(img.convert('L'))[:,:,None]
+        return path, img.shape[:2], texture_scores(img, cell)
+    except Exception as e:
+        print(">> Could not index texture of {}: {}".format(path, e))
+        return path, None, None
+
+
+class TextureIndex(object):
+    """
+    Texture scores of the images of a dataset on a coarse grid, stored with the
+    dataset, to draw the training crops from textured areas rather than from flat
+    sky or walls. Positions are drawn with probability
+    floor * uniform + (1 - floor) * texture of the crop window.
+    """
+
+    def __init__(self, datapath, paths, cell=32, refresh=False, processes=None):
+        """
+        :param string datapath: dataset folder, where the index is stored
+        :param list paths: images to index, those missing from the stored index are scored
+        :param int cell: size in pixels of the grid cells
+        :param bool refresh: score all the images again
+        :param int processes: processes scoring the images, all the CPUs if None
+        """
+        self.datapath = datapath
+        self.cell = cell
+        self.entries, self.scores = {}, np.zeros(0, dtype=np.float32)
+        path = os.path.join(datapath, TEXTURE_INDEX)
+        if os.path.isfile(path) and not refresh:
+            self.load(path)
+        missing = [p for p in paths if os.path.relpath(p, datapath) not in self.entries]
+        if missing:
+            self.build(missing, processes)
+            self.save(path)
+
+    def load(self, path):
+        data = np.load(path)
+        # Indexes stored in float16 overflowed to inf on high-contrast images
+        if int(data['cell']) != self.cell or data['scores'].dtype != np.float32:
+            return
+        self.scores = data['scores']
+        for rel, entry in zip(data['paths'], data['entries']):
+            self.entries[str(rel)] = tuple(int(v) for v in entry)
+
+    def build(self, paths, processes=None):
+        print(">> Indexing texture of {} images".format(len(paths)))
+        scores = [self.scores]
+        offset = len(self.scores)
+        pool = mp.Pool(processes)
+        try:
+            for path, shape, grid in pool.imap_unordered(_score_file, [(p, self.cell) for p in paths], chunksize=16):
+                if grid is None:
+                    continue
+                # Offset in the flat scores, grid and image shapes
+                self.entries[os.path.relpath(path, self.datapath)] = (offset,) + grid.shape + tuple(shape)
+                # Energies reach ~2e6, past the float16 range
+                scores.append(grid.ravel().astype(np.float32))
+                offset += grid.size
+        finally:
+            pool.close()
+            pool.join()
+        self.scores = np.concatenate(scores)
+
+    def save(self, path):
+        rels = sorted(self.entries)
+        try:
+            with open(path, 'wb') as f:
+                np.savez(
+                    f, cell=self.cell, scores=self.scores,
+                    paths=np.array(rels), entries=np.array([self.entries[r] for r in rels], dtype=np.int64).reshape(-1, 5)
+                )
+        except (IOError, OSError) as e:
+            print(">> Could not write texture index: {}".format(e))
+
+    def grid(self, path):
+        """Texture scores and indexed image shape of an image, None if not indexed"""
+        entry = self.entries.get(os.path.relpath(path, self.datapath))
+        if entry is None:
+            return None, None
+        offset, gh, gw, height, width = entry
+        return self.scores[offset:offset + gh * gw].reshape(gh, gw), (height, width)
+
+    def position(self, path, height, width, dy, dx, floor=0.2, rng=None):
+        """
+        Top left corner (y, x) of a dy x dx crop of the image, drawn by texture.
+        The image may be decoded at a lower resolution than the indexed one.
+        Uniform if the image is not indexed or smaller than a grid window.
+        Drawn from rng, a numpy RandomState, or from the global numpy one if None.
+        """
+        rng = np.random if rng is None else rng
+        grid, shape = self.grid(path)
+        if grid is not None:
+            # Cell size in pixels of the image as decoded
+            cy, cx = self.cell * height / float(shape[0]), self.cell * width / float(shape[1])
+            wy, wx = max(int(math.ceil(dy / cy)), 1), max(int(math.ceil(dx / cx)), 1)
+            ny, nx = grid.shape[0] - wy + 1, grid.shape[1] - wx + 1
+        if grid is None or ny < 1 or nx < 1:
+            return rng.randint(0, height - dy + 1), rng.randint(0, width - dx + 1)
+
+        # Texture of every window of wy x wx cells, through the integral image
+        integral = np.pad(grid.astype(np.float64).cumsum(0).cumsum(1), ((1, 0), (1, 0)), 'constant')
+        windows = integral[wy:, wx:] - integral[:-wy, wx:] - integral[wy:, :-wx] + integral[:-wy, :-wx]
+        p = np.maximum(windows.ravel(), 0)
+        total = p.sum()
+        p = floor / p.size + (1. - floor) * p / total if total > 0 else np.full(p.size, 1. / p.size)
+        i, j = divmod(rng.choice(p.size, p=p / p.sum()), nx)
+
+        # Jitter inside the cell
+        y = min(int((i + rng.uniform()) * cy), height - dy)
+        x = min(int((j + rng.uniform()) * cx), width - dx)
+        return y, x
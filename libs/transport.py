@@ -0,0 +1,118 @@
+import threading
+import multiprocessing as mp
+import numpy as np
+
+
+class SharedMemoryEnqueuer(object):
+    """
+    Feeds the batches of a DataLoader built in worker processes through a ring of
+    preallocated shared-memory slots. Workers write uint8 batches into a free slot
+    and only the slot number crosses the process boundary (no pickling); the
+    trainer scales the batch to float32 as it takes it out of the slot.
+    Same start / get / stop interface as keras OrderedEnqueuer.
+    """
+
+    def __init__(self, sequence, shuffle=False):
+        """
+        :param DataLoader sequence: loader built with scaled=False (or hr_only=True)
+        :param bool shuffle: shuffle the batch order at each epoch
+        """
+        self.sequence = sequence
+        self.shuffle = shuffle
+        self.shapes = [
+            (sequence.batch_size, sequence.height_hr, sequence.width_hr, sequence.channels)
+        ]
+        if not sequence.hr_only:
+            self.shapes.insert(0, (sequence.batch_size, sequence.height_lr, sequence.width_lr, sequence.channels))
+        self.workers = []
+        self.stop_event = None
+
+    def start(self, workers=1, max_queue_size=10):
+        """Allocate the slots and start the workers (each one can hold a slot while filling it)"""
+        n_slots = max_queue_size + workers
+        self.slots = [[mp.RawArray('B', int(np.prod(shape))) for shape in self.shapes] for _ in range(n_slots)]
+        self.free, self.ready = mp.Queue(), mp.Queue()
+        for slot in range(n_slots):
+            self.free.put(slot)
+        self.tasks = mp.Queue(maxsize=2 * n_slots)
+        self.stop_event = mp.Event()
+
+        self.workers = [mp.Process(target=self._run) for _ in range(workers)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+        self.feeder = threading.Thread(target=self._feed)
+        self.feeder.daemon = True
+        self.feeder.start()
+
+    def nbytes(self):
+        """Shared memory held by the slots"""
+        return sum(len(buf) for slot in self.slots for buf in slot)
+
+    def views(self, slot):
+        return [np.frombuffer(buf, dtype=np.uint8).reshape(shape) for buf, shape in zip(self.slots[slot], self.shapes)]
+
+    def _feed(self):
+        """Put numbered batch indexes in the task queue, epoch after epoch"""
+        n, epoch = 0, 0
+        while not self.stop_event.is_set():
+            idxs = np.arange(len(self.sequence))
+            if self.shuffle:
+                np.random.shuffle(idxs)
+            for idx in idxs:
+                if self.stop_event.is_set():
+                    return
+                self.tasks.put((n, epoch, int(idx)))
+                n += 1
+            epoch += 1
+
+    def _run(self):
+        """Worker process: build batches and copy them into free slots"""
+        # Forked workers share the parent random state
+        np.random.seed()
+        while not self.stop_event.is_set():
+            # Taking the slot before the task keeps the batches in order without deadlocks
+            slot = self.free.get()
+            n, epoch, idx = self.tasks.get()
+            try:
+                self.sequence.epoch = epoch
+                batch = self.sequence[idx]
+                arrays = batch if isinstance(batch, tuple) else (batch,)
+                for view, array in zip(self.views(slot), arrays):
+                    view[...] = array
+            except Exception as e:
+                print(e)
+                self.free.put(slot)
+                slot = None
+            self.ready.put((n, slot))
+
+    def get(self):
+        """Generator of scaled float32 (LR, HR) batches, or uint8 HR batches for hr_only loaders, in task order"""
+        pending, n_next = {}, 0
+        while True:
+            while n_next not in pending:
+                n, slot = self.ready.get()
+                pending[n] = slot
+            slot = pending.pop(n_next)
+            n_next += 1
+            if slot is None:
+                continue
+            views = self.views(slot)
+            if len(views) == 1:
+                batch = views[0].copy()
+            else:
+                imgs_lr = np.empty(self.shapes[0], dtype=np.float32)
+                imgs_hr = np.empty(self.shapes[1], dtype=np.float32)
+                np.multiply(views[0], np.float32(1 / 255.), out=imgs_lr)
+                np.multiply(views[1], np.float32(1 / 127.5), out=imgs_hr)
+                imgs_hr -= 1
+                batch = imgs_lr, imgs_hr
+            self.free.put(slot)
+            yield batch
+
+    def stop(self, timeout=None):
+        self.stop_event.set()
+        for worker in self.workers:
+            worker.terminate()
+            worker.join(timeout)
+        self.workers = []
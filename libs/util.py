@@ -1,6 +1,9 @@
 import os
 import gc
 import math
+import json
+import tempfile
+import multiprocessing as mp
 import numpy as np
 import cv2
 import imageio
@@ -9,14 +12,63 @@ import matplotlib.pyplot as plt
 
 from PIL import Image
 from random import choice
+from io import BytesIO
+from collections import OrderedDict
 from keras.utils import Sequence
 from keras import backend as K
 from losses import psnr2 as psnr
-
+from shards import PatchShards, SHARDS_META
+from videoindex import load_video_index, index_path
+from manifest import Manifest, VIDEO_EXTENSIONS
+from tarshards import TarShardStream, TAR_SHARDS_META
+from imagecache import SharedImageCache
+from textureindex import TextureIndex
+from telemetry import no_timing
+from degradation import BatchDegrader
+
+# Optional, for decoding only the region around a crop of JPEG images
+try:
+    from turbojpeg import TurboJPEG
+    turbojpeg = TurboJPEG()
+except Exception:
+    turbojpeg = None
+
+# Items failing to load in a row before a batch gives up
+MAX_FAILED_LOADS = 32
+
+
+class DecodeError(IOError):
+    """A file that is empty or not a decodable image, quarantined by the loader"""
+
+
+class CapturePool(object):
+    """Bounded pool of open cv2.VideoCapture handles, least recently used is released first"""
+
+    def __init__(self, max_open=8):
+        self.max_open = max_open
+        self.captures = OrderedDict()
+
+    def get(self, videopath):
+        cap = self.captures.pop(videopath, None)
+        if cap is None:
+            cap = cv2.VideoCapture(videopath)
+            if not cap.isOpened():
+                raise IOError("Error to open video: {}".format(videopath))
+        self.captures[videopath] = cap
+        while len(self.captures) > self.max_open:
+            self.captures.popitem(last=False)[1].release()
+        return cap
+
+    def release(self, videopath=None):
+        paths = list(self.captures) if videopath is None else [videopath]
+        for path in paths:
+            cap = self.captures.pop(path, None)
+            if cap is not None:
+                cap.release()
 
 
 class DataLoader(Sequence):
-    def __init__(self, datapath, batch_size, height_hr, width_hr, scale, crops_per_image, media_type,channels=3,colorspace='RGB'):
+    def __init__(self, datapath, batch_size, height_hr, width_hr, scale, crops_per_image, media_type,channels=3,colorspace='RGB',keyframes_only=False,frames_per_video=1,max_open_videos=8,hr_only=False,decode='full',scaled=True,sampler=None,refresh_manifest=False,stats=None,streams=1,shuffle_buffer=256,shuffle_bytes=256<<20,cache_bytes=0,texture_floor=None,vgg_features=None,rng=None):
         """        
         :param string datapath: filepath to training images
         :param int height_hr: Height of high-resolution images
@@ -24,6 +76,28 @@ class DataLoader(Sequence):
         :param int height_hr: Height of low-resolution images
         :param int width_hr: Width of low-resolution images
         :param int scale: Upscaling factor
+        :param string media_type: 'i' for images, 'v' for videos, 'p' for pre-extracted patch shards,
+            't' for images or videos packed in tar shards (see build_tar_shards.py)
+        :param bool keyframes_only: In video mode, sample only keyframes, which are cheap to seek
+        :param int frames_per_video: In video mode, frames read from each video in one forward pass
+        :param int max_open_videos: In video mode, open captures kept by each worker process
+        :param bool hr_only: Return only uint8 HR crops, to be degraded in batch (see BatchDegrader)
+        :param string decode: JPEG decoding for training crops: 'full', 'region' (only around each crop,
+            needs PyTurboJPEG) or 'draft' (reduced resolution decoding, i.e. downscale-first augmentation)
+        :param bool scaled: Scale color values, otherwise batches are returned as uint8
+        :param ShardedSampler sampler: Deterministic, sharded and resumable order of the items
+        :param bool refresh_manifest: Check every file of the dataset folder, not only those of its changed directories
+        :param LoaderStats stats: Accumulates the time spent in each loading stage
+        :param int streams: In tar mode, number of worker processes splitting the shards
+        :param int shuffle_buffer: In tar mode, files kept in memory by each stream to shuffle it
+        :param int shuffle_bytes: In tar mode, memory budget of the shuffle buffer of each stream, which
+            holds at most this plus its largest file
+        :param int cache_bytes: In image mode, memory budget of decoded images shared by the workers (0 to disable)
+        :param float texture_floor: In image mode, draw crops by texture (see TextureIndex) with this share
+            of uniform positions, 1 being uniform. None to disable
+        :param tuple vgg_features: In patch mode, (layer, preprocessing) of the cached VGG features
+            of the HR patches (see build_features.py), returned as a third batch item
+        :param RandomState rng: Random state of the crops, frames and sampled items, the global numpy one if None
         """
 
         # Store the datapath
@@ -35,9 +109,31 @@ class DataLoader(Sequence):
         self.width_lr = int(width_hr / scale)
         self.channels = channels
         self.colorspace = colorspace
+        # Luma only: decode straight to Y instead of converting to YCbCr and dropping Cb, Cr
+        self.luma = channels == 1 and colorspace == 'YCbCr'
+        self.decode_colorspace = 'L' if self.luma else colorspace
         self.scale = scale
         self.crops_per_image = crops_per_image
         self.media_type  = media_type
+        self.keyframes_only = keyframes_only
+        self.frames_per_video = frames_per_video
+        self.max_open_videos = max_open_videos
+        self.hr_only = hr_only
+        self.decode = decode
+        self.scaled = scaled
+        self.stats = stats
+        self.streams = streams
+        self.shuffle_buffer = shuffle_buffer
+        self.shuffle_bytes = shuffle_bytes
+        # Created before the enqueuer forks its workers, so that they all share it
+        self.image_cache = SharedImageCache(cache_bytes) if cache_bytes and media_type in ['i','p'] else None
+        self.texture_floor = texture_floor
+        self.vgg_features = vgg_features
+        self.rng = rng
+        self.texture_index = None
+        if self.decode == 'region' and turbojpeg is None:
+            print(">> PyTurboJPEG not found, decoding full images")
+            self.decode = 'full'
         self.total_imgs = None
         
         # Options for resizing
@@ -45,30 +141,134 @@ class DataLoader(Sequence):
         
         # Check data source
         self.img_paths = []
-
-        if os.path.isdir(self.datapath):
+        self.shards = None
+        self.manifest = None
+        self.refresh_manifest = refresh_manifest
+        self.quarantined = set()
+        self.tar_shards = None
+
+        if self.media_type == 'p' and os.path.isfile(os.path.join(self.datapath, SHARDS_META)):
+            self.get_shards()
+        elif self.media_type == 't' and os.path.isfile(os.path.join(self.datapath, TAR_SHARDS_META)):
+            self.get_tar_shards(sampler)
+        elif os.path.isdir(self.datapath):
             self.get_paths()
+
+        # Frame count, fps, resolution and keyframes of each video
+        self.video_indexes = {}
+        self.captures, self.captures_pid = None, None
+
+        # Items of each batch drawn by the sampler, tar shards are split by get_tar_shards instead
+        self.sampler = sampler if self.tar_shards is None else None
+        self.epoch = 0
+        if self.sampler is not None:
+            crops_per_item = self.crops_per_image * (self.frames_per_video if self.media_type == 'v' else 1)
+            per_batch = self.batch_size if self.shards is not None else int(math.ceil(self.batch_size / float(crops_per_item)))
+            self.sampler.set_size(self.total_imgs, per_batch)
+        if self.media_type == 'v':
+            self.get_video_indexes()
     
     def get_paths(self):
-        for dirpath, _, filenames in os.walk(self.datapath):
-            for filename in [f for f in filenames if any(filetype in f.lower() for filetype in ['jpeg', 'png', 'jpg','mp4','264','webm','wma'])]:
-                self.img_paths.append(os.path.join(dirpath, filename))
+        self.manifest = Manifest(self.datapath, refresh=self.refresh_manifest)
+        self.img_paths = self.manifest.paths(min_height=self.height_hr, min_width=self.width_hr)
         self.total_imgs = len(self.img_paths)
         print(">> Found {} images in dataset".format(self.total_imgs))
+        if self.texture_floor is not None and self.media_type in ['i','p']:
+            self.texture_index = TextureIndex(self.datapath, self.img_paths, refresh=self.refresh_manifest)
+
+    def get_video_indexes(self):
+        videopaths = self.img_paths if os.path.isdir(self.datapath) else [self.datapath]
+        for videopath in videopaths:
+            try:
+                self.get_video_index(videopath)
+            except Exception as e:
+                self.quarantine(videopath, e)
+        if os.path.isdir(self.datapath):
+            self.img_paths = [p for p in self.img_paths if p in self.video_indexes]
+            self.total_imgs = len(self.img_paths)
+
+    def quarantine(self, path, error):
+        """Skip a file that failed to load, in this process and in the next runs"""
+        print(">> Skipping {}: {}".format(path, error))
+        self.quarantined.add(path)
+        if self.manifest is not None:
+            self.manifest.quarantine(path, error)
+
+    def get_video_index(self, videopath):
+        if videopath not in self.video_indexes:
+            self.video_indexes[videopath] = load_video_index(videopath)
+        return self.video_indexes[videopath]
+
+    def get_tar_shards(self, sampler=None):
+        with open(os.path.join(self.datapath, TAR_SHARDS_META)) as f:
+            shards = json.load(f)['shards']
+        self.stream_seed = None
+        if sampler is not None:
+            shards = shards[sampler.shard_index::sampler.num_shards]
+            self.stream_seed = sampler.seed
+        self.tar_shards = [os.path.join(self.datapath, s['path']) for s in shards]
+        self.total_imgs = sum(s['count'] for s in shards)
+        self.stream, self.stream_pid = None, None
+        self.stream_counter = mp.Value('i', 0)
+        print(">> Found {} files in {} tar shards".format(self.total_imgs, len(self.tar_shards)))
+
+    def get_stream(self):
+        """Stream of this worker process, over its part of the tar shards"""
+        if self.stream_pid != os.getpid():
+            # Worker slot, the same for each worker of a restarted pool
+            with self.stream_counter.get_lock():
+                slot = self.stream_counter.value
+                self.stream_counter.value = (slot + 1) % self.streams
+            shards = self.tar_shards
+            if len(shards) >= self.streams:
+                shards = shards[slot % self.streams::self.streams]
+            seed = None if self.stream_seed is None else self.stream_seed + slot
+            self.stream = iter(TarShardStream(shards, self.shuffle_buffer, seed, self.shuffle_bytes))
+            self.stream_pid = os.getpid()
+        return self.stream
+
+    def get_shards(self):
+        self.shards = PatchShards(self.datapath)
+        meta = self.shards.meta
+        if (meta['height_hr'], meta['width_hr'], meta['scale'], meta['colorspace']) != (self.height_hr, self.width_hr, self.scale, self.colorspace):
+            raise ValueError('Patch shards in {} were built with {}x{} crops, scale {} and {} colorspace'.format(
+                self.datapath, meta['height_hr'], meta['width_hr'], meta['scale'], meta['colorspace']))
+        self.total_imgs = len(self.shards)
+        print(">> Found {} patches in {} shards".format(self.total_imgs, len(meta['shards'])))
+        if self.vgg_features is not None:
+            layer, preprocessing = self.vgg_features
+            self.shards.use_features(layer, preprocessing, self.channels)
     
-    def random_crop(self, img, random_crop_size):
+    @property
+    def random(self):
+        """Random state of the loader, its own or the global numpy one"""
+        return np.random if self.rng is None else self.rng
+
+    def random_crop(self, img, random_crop_size, path=None):
         # Note: image_data_format is 'channel_last'
-        assert img.shape[2] == 3
+        assert img.shape[2] in (1, 3)
         height, width = img.shape[0], img.shape[1]
         dy, dx = random_crop_size
-        x = np.random.randint(0, width - dx + 1)
-        y = np.random.randint(0, height - dy + 1)
+        y, x = self.crop_position(path, height, width, dy, dx)
         return img[y:(y+dy), x:(x+dx), :]
 
+    def crop_position(self, path, height, width, dy, dx):
+        """Top left corner of a crop, drawn by texture if the image is indexed"""
+        if self.texture_index is not None and path is not None:
+            return self.texture_index.position(path, height, width, dy, dx, self.texture_floor, self.rng)
+        return self.random.randint(0, height - dy + 1), self.random.randint(0, width - dx + 1)
+
+    def degrade_image(self, img_hr):
+        """Blur and bicubic downscale of a HR image, as uint8"""
+        lr_shape = (int(img_hr.shape[1]/self.scale), int(img_hr.shape[0]/self.scale))
+        img_lr = cv2.resize(cv2.GaussianBlur(img_hr,(5,5),0),lr_shape, interpolation = cv2.INTER_CUBIC)
+        # OpenCV drops the channel axis of single channel images
+        return img_lr.reshape(lr_shape[1], lr_shape[0], img_hr.shape[2])
+
     @staticmethod
     def scale_lr_imgs(imgs):
-        """Scale low-res images prior to passing to SRGAN"""
-        return imgs / 255.
+        """Scale low-res images prior to passing to SRGAN, as float32"""
+        return np.asarray(imgs, dtype=np.float32) / 255.
     
     @staticmethod
     def unscale_lr_imgs(imgs):
@@ -80,8 +280,8 @@ class DataLoader(Sequence):
     
     @staticmethod
     def scale_hr_imgs(imgs):
-        """Scale high-res images prior to passing to SRGAN"""
-        return imgs / 127.5 - 1
+        """Scale high-res images prior to passing to SRGAN, as float32"""
+        return np.asarray(imgs, dtype=np.float32) / 127.5 - 1
     
     @staticmethod
     def unscale_hr_imgs(imgs):
@@ -109,49 +309,178 @@ class DataLoader(Sequence):
 
     def get_random_frames(self,n_fms=1,videopath=None):
         """Get random number of video frames"""
-        t_frames = self.count_frames(videopath)
-        choiced_frames = np.random.randint(t_frames, size=n_fms)
+        index = self.get_video_index(videopath)
+        if self.keyframes_only and index['keyframes']:
+            return self.random.choice(index['keyframes'], size=n_fms)
+        choiced_frames = self.random.randint(index['frames'], size=n_fms)
         return choiced_frames
     
     @staticmethod
     def load_img(path,colorspace='YCbCr'):
-        img = Image.open(path)
+        """Decode an image to an HxWxC uint8 array, colorspace 'L' decoding the luma only"""
+        img = path if isinstance(path, Image.Image) else Image.open(path)
         if (colorspace ==  'YCbCr' and img.mode != 'YCbCr'):
             img = img.convert('YCbCr') 
         if (colorspace ==  'RGB' and img.mode != 'RGB'):
             img = img.convert('RGB')     
-        return np.array(img)
+        if (colorspace ==  'L' and img.mode != 'L'):
+            # JPEG: libjpeg outputs the Y plane, chroma is neither upsampled nor converted
+            img.draft('L', img.size)
+            img = img.convert('L')
+        img = np.array(img)
+        return img[:,:,None] if img.ndim == 2 else img
+
+    def decode_img(self, path):
+        """Whole decoded image, DecodeError if the file is empty or not a valid image"""
+        try:
+            if os.path.getsize(path) == 0:
+                raise IOError('Empty file')
+            return self.load_img(path, self.decode_colorspace)
+        except (IOError, OSError, SyntaxError) as e:
+            raise DecodeError(e)
+
+    def load_img_cached(self, path):
+        """Decoded image, from the shared cache if any"""
+        if self.image_cache is None:
+            return self.decode_img(path)
+        return self.image_cache.load(path, self.decode_colorspace, lambda: self.decode_img(path))
+
+    def load_img_crops(self, path, n_crops):
+        """Random crops of an image, picked from the header dimensions and decoding only what they need"""
+        dy, dx = self.height_hr, self.width_hr
+        img = Image.open(path)
+        if img.format != 'JPEG':
+            img = self.load_img(path, self.decode_colorspace)
+            return [self.random_crop(img, (dy, dx), path) for _ in range(n_crops)]
+
+        width, height = img.size
+        if self.decode == 'draft':
+            # Largest DCT scaling that still fits the crop
+            factor = max([f for f in [1, 2, 4, 8] if width // f >= dx and height // f >= dy] or [1])
+            img.draft(self.decode_colorspace, (width // factor, height // factor))
+            img = self.load_img(img, self.decode_colorspace)
+            return [self.random_crop(img, (dy, dx), path) for _ in range(n_crops)]
+
+        with open(path, 'rb') as f:
+            buf = f.read()
+        crops = []
+        for _ in range(n_crops):
+            y, x = self.crop_position(path, height, width, dy, dx)
+            # Lossless crop must start on an MCU boundary
+            x0, y0 = x - x % 16, y - y % 16
+            region = turbojpeg.crop(buf, x0, y0, min(x - x0 + dx, width - x0), min(y - y0 + dy, height - y0))
+            region = self.load_img(BytesIO(region), self.decode_colorspace)
+            crops.append(region[(y-y0):(y-y0+dy), (x-x0):(x-x0+dx), :])
+        return crops
      
+    def get_capture(self, videopath):
+        """Open capture of a video from the pool of this worker process"""
+        if self.captures_pid != os.getpid():
+            # Handles inherited from a forked parent must not be shared
+            self.captures, self.captures_pid = CapturePool(self.max_open_videos), os.getpid()
+        return self.captures.get(videopath)
+
     def load_frame(self,videopath):
-        """Get n_imgs random frames from the video"""
-        choiced_frame=self.get_random_frames(1,videopath)
-        #print("Frame no.: ",choiced_frame)
-        cap = cv2.VideoCapture(videopath) 
-        cap.set(1,choiced_frame)
-        ret, frame = cap.read()
-        if not ret:
-            print(">> Erro to access frames.")
-            return -1
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        cap.release()
-        return np.array(frame)
+        """Get a random frame from the video"""
+        return self.load_frames(videopath, 1)[0]
+
+    def load_frames(self, videopath, n_fms=1):
+        """Get n_fms random frames from the video in one forward pass over sorted frame numbers"""
+        choiced_frames = np.sort(self.get_random_frames(n_fms, videopath))
+        keyframes = self.get_video_index(videopath)['keyframes']
+        cap = self.get_capture(videopath)
+        frames = []
+        for choiced_frame in choiced_frames:
+            pos = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+            # Seek only when decoding forward would cost more than decoding from the keyframe
+            if keyframes:
+                prev_key = keyframes[max(np.searchsorted(keyframes, choiced_frame, side='right') - 1, 0)]
+                seek = choiced_frame < pos or prev_key > pos
+            else:
+                seek = choiced_frame < pos or choiced_frame - pos > 64
+            if seek:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, choiced_frame)
+            else:
+                for _ in range(choiced_frame - pos):
+                    cap.grab()
+            ret, frame = cap.read()
+            if not ret:
+                self.captures.release(videopath)
+                raise IOError(">> Erro to access frame {} of {}".format(choiced_frame, videopath))
+            if self.luma:
+                frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)[:,:,None])
+            else:
+                frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        return frames
      
+    def load_failed(self, failures, items=None, cur_idx=0):
+        """
+        Count an item of a batch that failed to load, replacing it in the sampled
+        items by another item of the shard, and raise after MAX_FAILED_LOADS in a row
+        """
+        if failures >= MAX_FAILED_LOADS:
+            raise IOError('{} items in a row failed to load from {}'.format(failures, self.datapath))
+        if items is not None:
+            pool = self.sampler.items if self.sampler is not None else np.arange(self.total_imgs)
+            items[cur_idx % len(items)] = self.random.choice(pool)
+        return failures
+
+    def get_path(self, cur_idx, items=None):
+        """Path of the cur_idx-th item of a batch, cycling over the sampled items if any"""
+        if items is not None:
+            return self.img_paths[items[cur_idx % len(items)]]
+        return self.img_paths[cur_idx]
+
+    def close(self):
+        """Remove the shared image cache, once the workers using it are stopped"""
+        if self.image_cache is not None:
+            self.image_cache.close()
+
+    def batch_nbytes(self):
+        """Bytes of one batch as returned by __getitem__ (scaled batches are float32)"""
+        itemsize = 4 if self.scaled and not self.hr_only else 1
+        hr = self.batch_size * self.height_hr * self.width_hr * self.channels
+        lr = 0 if self.hr_only else self.batch_size * self.height_lr * self.width_lr * self.channels
+        return (hr + lr) * itemsize
+
+    def timed(self, stage):
+        """Context timing a loading stage, if stats are collected"""
+        return self.stats.time(stage) if self.stats is not None else no_timing()
+
     # Every Sequence must implement the __getitem__ and the __len__ methods. 
     def __len__(self):
+        if self.sampler is not None:
+            return len(self.sampler)
         return int(self.total_imgs / float(self.batch_size))
     
     def __getitem__(self, idx):
-        return self.load_batch(idx=idx)        
-
-
-    def load_batch(self,idx=0, img_paths=None, training=True, bicubic=False):
-        """ Loads a batch of images or video"""
-        if(self.media_type=='i'):
+        items = None
+        if self.sampler is not None:
+            # Batch number since the start of the sampler, crops seeded by it
+            step = self.sampler.step + self.epoch * len(self) + idx
+            items = self.sampler.batch(step)
+            self.random.seed(self.sampler.batch_seed(step))
+        if self.hr_only:
+            return self.load_batch(idx=idx, items=items)[1]
+        return self.load_batch(idx=idx, items=items)        
+
+    def on_epoch_end(self):
+        self.epoch += 1
+
+
+    def load_batch(self,idx=0, img_paths=None, training=True, bicubic=False, items=None):
+        """ Loads a batch of images or video (items: dataset indexes to take the crops from)"""
+        if(self.media_type=='p' and self.shards is not None and img_paths is None):
+            # With cached VGG features of the HR patches as third item
+            return self.load_batch_patches(items)
+        elif(self.media_type=='t' and self.tar_shards is not None and img_paths is None):
+            imgs_lr, imgs_hr = self.load_batch_stream()
+        elif(self.media_type in ['i','p','t']):
             #print("1. Media type image folder")
-            imgs_lr, imgs_hr = self.load_batch_image(idx, img_paths=img_paths, training=training,bicubic=False)
+            imgs_lr, imgs_hr = self.load_batch_image(idx, img_paths=img_paths, training=training,bicubic=False, items=items)
         elif(self.media_type=='v' and os.path.isdir(self.datapath)):
             #print("2. Media type video folder")
-            imgs_lr, imgs_hr = self.load_batch_video(idx, img_paths=None, training=training, bicubic=False)
+            imgs_lr, imgs_hr = self.load_batch_video(idx, img_paths=None, training=training, bicubic=False, items=items)
         elif(self.media_type=='v' and not os.path.isdir(self.datapath)):
             #print("3. Media type single video")
             imgs_lr, imgs_hr = self.load_batch_video(idx, img_paths=self.datapath, training=training, bicubic=False)
@@ -160,16 +489,20 @@ class DataLoader(Sequence):
         return imgs_lr, imgs_hr
 
 
-    def load_batch_video(self, idx=0, img_paths=None, training=True, bicubic=False):
+    def load_batch_video(self, idx=0, img_paths=None, training=True, bicubic=False, items=None):
         """Loads a batch of frames from videos folder""" 
         # Starting index to look in
         cur_idx = 0
-        if not img_paths:
+        if not img_paths and items is None:
             cur_idx = idx*self.batch_size            
         #print('cur_idx:',cur_idx)
+        # Failed items are replaced in a copy, the sampler permutation is kept
+        if items is not None:
+            items = np.array(items)
             
         # Scale and pre-process images
         imgs_hr, imgs_lr = [], []
+        failures = 0
         while True:
 
             # Check if done with batch
@@ -182,25 +515,26 @@ class DataLoader(Sequence):
                 break            
             
             try: 
-                # Load image
-                img_hr = None
-                if img_paths:
-                    #print('1. video: ',img_paths[cur_idx])
-                    img_hr = self.load_frame(img_paths[cur_idx])
-                    #print(img_hr.shape)
-                else:
-                    #print('2. video: ',self.img_paths[cur_idx])
-                    img_hr = self.load_frame(self.img_paths[cur_idx])
-                    #print(img_hr.shape)
+                # Load frames
+                frames = None
+                with self.timed('decode'):
+                    if img_paths:
+                        #print('1. video: ',img_paths[cur_idx])
+                        frames = self.load_frames(img_paths[cur_idx], self.frames_per_video if training else 1)
+                    else:
+                        #print('2. video: ',self.img_paths[cur_idx])
+                        frames = self.load_frames(self.get_path(cur_idx, items), self.frames_per_video if training else 1)
 
                 # Create HR images to go through
                 img_crops = []
                 if training:
-                    for i in range(self.crops_per_image):
-                        #print(idx, cur_idx, "Loading crop: ", i)
-                        img_crops.append(self.random_crop(img_hr, (self.height_hr, self.width_hr)))
+                    with self.timed('crop'):
+                        for img_hr in frames:
+                            for i in range(self.crops_per_image):
+                                #print(idx, cur_idx, "Loading crop: ", i)
+                                img_crops.append(self.random_crop(img_hr, (self.height_hr, self.width_hr)))
                 else:
-                    img_crops = [img_hr]
+                    img_crops = frames
 
                 # Downscale the HR images and save
                 for img_hr in img_crops:
@@ -214,48 +548,64 @@ class DataLoader(Sequence):
                     if img_paths is not None and len(imgs_hr) == len(img_paths):
                         break   
 
+                    # Keep only HR, the LR batch is built by the consumer
+                    if self.hr_only:
+                        imgs_hr.append(img_hr[:,:,:self.channels])
+                        continue
+
                     # For LR, do bicubic downsampling
-                    method = Image.BICUBIC if bicubic else choice(self.options)
-                    lr_shape = (int(img_hr.shape[1]/self.scale), int(img_hr.shape[0]/self.scale))           
-                    img_lr = Image.fromarray(img_hr.astype(np.uint8))
-                    img_lr = np.array(img_lr.resize(lr_shape, method))
+                    with self.timed('degradation'):
+                        method = Image.BICUBIC if bicubic else choice(self.options)
+                        lr_shape = (int(img_hr.shape[1]/self.scale), int(img_hr.shape[0]/self.scale))           
+                        img_lr = Image.fromarray(img_hr[:,:,0] if self.luma else img_hr.astype(np.uint8))
+                        img_lr = np.array(img_lr.resize(lr_shape, method)).reshape(lr_shape[1], lr_shape[0], -1)
 
                     # Scale color values
-                    img_hr = self.scale_hr_imgs(img_hr)
-                    img_lr = self.scale_lr_imgs(img_lr)
+                    if self.scaled:
+                        with self.timed('scaling'):
+                            img_hr = self.scale_hr_imgs(img_hr)
+                            img_lr = self.scale_lr_imgs(img_lr)
 
                     # Store images
                     #print(img_hr[:,:,:self.channels].shape,img_lr[:,:,:self.channels].shape)
                     imgs_hr.append(img_hr[:,:,:self.channels])
                     imgs_lr.append(img_lr[:,:,:self.channels])
+                failures = 0
                 
             except Exception as e:
                 print(e)
-                pass
+                failures = self.load_failed(failures + 1, items, cur_idx)
             finally:
                 cur_idx += 1
 
         # Convert to numpy arrays when we are training 
         # Note: all are cropped to same size, which is not the case when not training
         if training:
-            imgs_hr = np.array(imgs_hr)
-            imgs_lr = np.array(imgs_lr)
+            with self.timed('assembly'):
+                imgs_hr = np.array(imgs_hr)
+                imgs_lr = np.array(imgs_lr)
+            if self.stats is not None:
+                self.stats.batch_done()
 
         # Return image batch
         return imgs_lr, imgs_hr
 
 
-    def load_batch_image(self, idx=0, img_paths=None, training=True, bicubic=True):
+    def load_batch_image(self, idx=0, img_paths=None, training=True, bicubic=True, items=None):
         """Loads a batch of images from datapath folder""" 
 
         # Starting index to look in
         cur_idx = 0
         
-        if not img_paths:
+        if not img_paths and items is None:
             cur_idx = idx*self.batch_size
+        # Failed items are replaced in a copy, the sampler permutation is kept
+        if items is not None:
+            items = np.array(items)
             
         # Scale and pre-process images
         imgs_hr, imgs_lr = [], []
+        failures = 0
         while True:
 
             # Check if done with batch
@@ -264,25 +614,43 @@ class DataLoader(Sequence):
                     cur_idx = 0
                 if len(imgs_hr) >= self.batch_size:
                     break
-            if img_paths is not None and len(imgs_hr) == len(img_paths):
+            # Explicit paths are loaded once each, those failing are left out
+            if img_paths is not None and (len(imgs_hr) == len(img_paths) or cur_idx >= len(img_paths)):
                 break            
             
+            img_path = None
+            failed = False
             try: 
                 # Load image
                 img_hr = None
-                if img_paths:
-                    img_hr = self.load_img(img_paths[cur_idx],self.colorspace)
-                else:
-                    img_hr = self.load_img(self.img_paths[cur_idx],self.colorspace)
+                img_path = img_paths[cur_idx] if img_paths else self.get_path(cur_idx, items)
+                if img_path in self.quarantined:
+                    failed = True
+                    continue
+                # Cached images are whole, they are not decoded again by crops
+                full = not training or self.decode == 'full' or self.image_cache is not None
                     
                 # Create HR images to go through
                 img_crops = []
-                if training:
-                    for i in range(self.crops_per_image):
-                        #print(idx, cur_idx, "Loading crop: ", i)
-                        img_crops.append(self.random_crop(img_hr, (self.height_hr, self.width_hr)))
-                else:
+                if training and not full:
+                    # Decoding and cropping are done together, a failure is decided by a full decode
+                    try:
+                        with self.timed('decode'):
+                            img_crops = self.load_img_crops(img_path, self.crops_per_image)
+                    except Exception as e:
+                        print(">> {} decode of {} failed, decoding it whole: {}".format(self.decode, img_path, e))
+                        full = True
+                if full:
+                    with self.timed('decode'):
+                        img_hr = self.load_img_cached(img_path)
+                    
+                if not training:
                     img_crops = [img_hr]
+                elif full:
+                    with self.timed('crop'):
+                        for i in range(self.crops_per_image):
+                            #print(idx, cur_idx, "Loading crop: ", i)
+                            img_crops.append(self.random_crop(img_hr, (self.height_hr, self.width_hr), img_path))
 
                 # Downscale the HR images and save
                 for img_hr in img_crops:
@@ -296,6 +664,11 @@ class DataLoader(Sequence):
                     if img_paths is not None and len(imgs_hr) == len(img_paths):
                         break   
 
+                    # Keep only HR, the LR batch is built by the consumer
+                    if self.hr_only:
+                        imgs_hr.append(img_hr[:,:,:self.channels])
+                        continue
+
                     # For LR, do bicubic downsampling
                     # method = Image.BICUBIC if bicubic else choice(self.options)
                     # lr_shape = (int(img_hr.shape[1]/self.scale), int(img_hr.shape[0]/self.scale))           
@@ -303,38 +676,220 @@ class DataLoader(Sequence):
                     # img_lr = np.array(img_lr.resize(lr_shape, method))
 
                     # For LR, do bicubic downsampling
-                    lr_shape = (int(img_hr.shape[1]/self.scale), int(img_hr.shape[0]/self.scale))  
-                    img_lr = cv2.resize(cv2.GaussianBlur(img_hr,(5,5),0),lr_shape, interpolation = cv2.INTER_CUBIC)
+                    with self.timed('degradation'):
+                        img_lr = self.degrade_image(img_hr)
 
 
                     # Scale color values
-                    img_hr = self.scale_hr_imgs(img_hr)
-                    img_lr = self.scale_lr_imgs(img_lr)
+                    if self.scaled:
+                        with self.timed('scaling'):
+                            img_hr = self.scale_hr_imgs(img_hr)
+                            img_lr = self.scale_lr_imgs(img_lr)
 
                     # Store images
                     #print(img_hr[:,:,:self.channels].shape,img_lr[:,:,:self.channels].shape)
                     imgs_hr.append(img_hr[:,:,:self.channels])
                     imgs_lr.append(img_lr[:,:,:self.channels])
+                failures = 0
                 
+            except DecodeError as e:
+                # Only files that cannot be decoded are skipped in the next runs
+                failed = True
+                self.quarantine(img_path, e)
             except Exception as e:
-                print(e)
-                pass
+                failed = True
+                print(">> Could not load {}: {}".format(img_path, e))
             finally:
+                if failed:
+                    failures = self.load_failed(failures + 1, items, cur_idx)
                 cur_idx += 1
 
         # Convert to numpy arrays when we are training 
         # Note: all are cropped to same size, which is not the case when not training
         if training:
-            imgs_hr = np.array(imgs_hr)
-            imgs_lr = np.array(imgs_lr)
+            with self.timed('assembly'):
+                imgs_hr = np.array(imgs_hr)
+                imgs_lr = np.array(imgs_lr)
+            if self.stats is not None:
+                self.stats.batch_done()
 
         # Return image batch
         return imgs_lr, imgs_hr
+
+
+    def load_frames_from_bytes(self, name, data, n_fms):
+        """Random frames of a video read from memory, through a temporary file"""
+        tmpdir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        fd, path = tempfile.mkstemp(suffix=os.path.splitext(name)[1], dir=tmpdir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            return self.load_frames(path, n_fms)
+        finally:
+            if self.captures is not None:
+                self.captures.release(path)
+            self.video_indexes.pop(path, None)
+            for p in [path, index_path(path)]:
+                if os.path.isfile(p):
+                    os.remove(p)
+
+    def load_batch_stream(self):
+        """Loads a batch from the sequential tar shard stream of this worker"""
+        stream = self.get_stream()
+        imgs_hr, imgs_lr = [], []
+        while len(imgs_hr) < self.batch_size:
+            name, data = next(stream)
+            video = name.lower().endswith(VIDEO_EXTENSIONS)
+            try:
+                with self.timed('decode'):
+                    if video:
+                        frames = self.load_frames_from_bytes(name, data, self.frames_per_video)
+                    else:
+                        frames = [self.load_img(BytesIO(data), self.decode_colorspace)]
+                with self.timed('crop'):
+                    img_crops = [self.random_crop(img, (self.height_hr, self.width_hr)) for img in frames for _ in range(self.crops_per_image)]
+            except Exception as e:
+                print(">> Skipping {}: {}".format(name, e))
+                continue
+
+            for img_hr in img_crops[:self.batch_size - len(imgs_hr)]:
+                if self.hr_only:
+                    imgs_hr.append(img_hr[:,:,:self.channels])
+                    continue
+                with self.timed('degradation'):
+                    if video:
+                        lr_shape = (int(img_hr.shape[1]/self.scale), int(img_hr.shape[0]/self.scale))
+                        img_lr = Image.fromarray(img_hr[:,:,0] if self.luma else img_hr)
+                        img_lr = np.array(img_lr.resize(lr_shape, choice(self.options))).reshape(lr_shape[1], lr_shape[0], -1)
+                    else:
+                        img_lr = self.degrade_image(img_hr)
+                if self.scaled:
+                    with self.timed('scaling'):
+                        img_hr = self.scale_hr_imgs(img_hr)
+                        img_lr = self.scale_lr_imgs(img_lr)
+                imgs_hr.append(img_hr[:,:,:self.channels])
+                imgs_lr.append(img_lr[:,:,:self.channels])
+
+        with self.timed('assembly'):
+            imgs_hr = np.array(imgs_hr)
+            imgs_lr = np.array(imgs_lr)
+        if self.stats is not None:
+            self.stats.batch_done()
+        return imgs_lr, imgs_hr
+
+    def load_batch_patches(self, items=None):
+        """Samples a batch of pre-extracted LR/HR patches from the memory-mapped shards"""
+        idxs = self.random.randint(0, self.total_imgs, self.batch_size) if items is None else items
+        with self.timed('decode'):
+            batch = self.shards.gather(idxs)
+        imgs_lr, imgs_hr = batch[:2]
+        if self.stats is not None:
+            self.stats.batch_done()
+        if self.hr_only:
+            return None, imgs_hr[:,:,:,:self.channels]
+        imgs_hr = imgs_hr[:,:,:,:self.channels]
+        imgs_lr = imgs_lr[:,:,:,:self.channels]
+        if self.scaled:
+            with self.timed('scaling'):
+                imgs_hr = self.scale_hr_imgs(imgs_hr)
+                imgs_lr = self.scale_lr_imgs(imgs_lr)
+        return (imgs_lr, imgs_hr) + tuple(batch[2:])
+
+    def as_dataset(self, cache=False, shuffle_buffer=1024, cycle_length=8):
+        """
+        Same training batches as the Sequence interface, built by a tf.data graph:
+        parallel interleave over the files, parallel decode / crop / degradation
+        and autotuned prefetch. Only image folders are supported. With a sampler, the
+        file order is drawn from its seed and the files of the batches it already
+        consumed are skipped before being read (with a cache, once it is filled), so a
+        resumed run continues the stream instead of starting it over. The random crops
+        are not those of the interrupted run.
+
+        :param cache: cache the decoded images, in memory (True) or in a file (path)
+        :param int shuffle_buffer: size of the shuffle buffers
+        :param int cycle_length: number of files read concurrently
+        """
+        if self.media_type != 'i':
+            raise ValueError('tf.data input only supports image folders (media_type i). You chose {}'.format(self.media_type))
+        autotune = tf.data.experimental.AUTOTUNE
+        seed = None
+        skipped = 0
+
+        files = tf.data.Dataset.from_tensor_slices(self.img_paths)
+        if self.sampler is not None:
+            files = files.shard(self.sampler.num_shards, self.sampler.shard_index)
+            seed = self.sampler.seed
+            # Images the consumed batches were cropped from
+            skipped = self.sampler.step * self.batch_size // self.crops_per_image
+            if skipped:
+                print(">> Skipping the {} images of the {} batches consumed before resuming".format(skipped, self.sampler.step))
+        if not cache:
+            files = files.shuffle(len(self.img_paths), seed=seed).repeat().skip(skipped)
+
+        def decode(data):
+            if self.luma:
+                # libjpeg decodes the Y plane only
+                return tf.image.decode_image(data, channels=1, expand_animations=False)
+            img = tf.image.decode_image(data, channels=3, expand_animations=False)
+            if self.colorspace == 'YCbCr':
+                img = rgb_to_ycbcr(img)
+            return img
+
+        def large_enough(img):
+            shape = tf.shape(img)
+            return tf.logical_and(shape[0] >= self.height_hr, shape[1] >= self.width_hr)
+
+        images = files.interleave(
+            lambda path: tf.data.Dataset.from_tensors(tf.read_file(path)),
+            cycle_length=cycle_length,
+            num_parallel_calls=autotune
+        )
+        images = images.map(decode, num_parallel_calls=autotune).filter(large_enough)
+        if cache:
+            # Skipped after the cache, which needs all the images
+            images = images.cache('' if cache is True else cache).shuffle(shuffle_buffer, seed=seed).repeat().skip(skipped)
+
+        def crop(img):
+            return tf.stack([tf.random_crop(img, [self.height_hr, self.width_hr, 1 if self.luma else 3]) for _ in range(self.crops_per_image)])
+
+        def degrade(img_hr):
+            img_hr = img_hr[:,:,:self.channels]
+            if self.hr_only:
+                return img_hr
+            # Blur and bicubic downscale, as degrade_image
+            img_lr = BatchDegrader.gaussian_blur(tf.cast(img_hr[None], tf.float32), self.channels)
+            img_lr = tf.image.resize_images(img_lr, (self.height_lr, self.width_lr), method=tf.image.ResizeMethod.BICUBIC)[0]
+            img_lr = tf.clip_by_value(tf.round(img_lr), 0., 255.)
+            if not self.scaled:
+                return tf.cast(img_lr, tf.uint8), img_hr
+            return img_lr / 255., tf.cast(img_hr, tf.float32) / 127.5 - 1
+
+        crops = images.map(crop, num_parallel_calls=autotune).apply(tf.data.experimental.unbatch())
+        crops = crops.shuffle(shuffle_buffer, seed=seed)
+        batches = crops.map(degrade, num_parallel_calls=autotune).batch(self.batch_size, drop_remainder=True)
+        return batches.prefetch(autotune)
+
+    @staticmethod
+    def iterate(dataset):
+        """Generator over the batches of a tf.data dataset, in place of an enqueuer"""
+        next_batch = dataset.make_one_shot_iterator().get_next()
+        session = K.get_session()
+        while True:
+            yield session.run(next_batch)
     
     
     
 
 
+def rgb_to_ycbcr(img):
+    """JPEG (JFIF) RGB to YCbCr conversion as done by PIL, for uint8 image tensors"""
+    matrix = tf.constant([[0.299, -0.168736, 0.5],
+                          [0.587, -0.331264, -0.418688],
+                          [0.114, 0.5, -0.081312]])
+    img = tf.tensordot(tf.cast(img, tf.float32), matrix, axes=1) + [0., 128., 128.]
+    return tf.cast(tf.clip_by_value(tf.round(img), 0., 255.), tf.uint8)
+
+
 def plot_test_images(model, loader, datapath_test, test_output, epoch, name='SRGAN', channels = 3,colorspace='RGB'):
     
     try:   
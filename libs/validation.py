@@ -0,0 +1,155 @@
+import os
+import math
+import threading
+import numpy as np
+from keras.utils import Sequence
+
+
+VALIDATION_SET = '.validation.npz'
+
+
+class FixedValidationSet(Sequence):
+    """
+    Validation LR/HR crops drawn once with a seed, stored with the validation data
+    and kept in memory as scaled float32 arrays, so that validation only costs the
+    model compute and its losses do not move with the sampling of the crops.
+    """
+
+    def __init__(self, loader, count, seed=0, batch_size=64, path=None, writer=True):
+        """
+        :param DataLoader loader: validation loader built with scaled=False
+        :param int count: number of crops
+        :param int seed: seed of the crops and degradations
+        :param int batch_size: batch size of the evaluation
+        :param string path: file of the stored set, .validation.npz in the validation folder if None
+        :param bool writer: store the set when it is missing, False on all but one of the processes sharing it
+        """
+        self.batch_size = batch_size
+        self.meta = {
+            'count': count, 'seed': seed,
+            'height_hr': loader.height_hr, 'width_hr': loader.width_hr, 'scale': loader.scale,
+            'channels': loader.channels, 'colorspace': loader.colorspace, 'media_type': loader.media_type
+        }
+        if path is None:
+            folder = loader.datapath if os.path.isdir(loader.datapath) else os.path.dirname(loader.datapath)
+            path = os.path.join(folder, VALIDATION_SET)
+
+        imgs = self.load(path)
+        if imgs is None:
+            imgs = self.build(loader, count, seed)
+            if writer:
+                self.save(path, *imgs)
+        imgs_lr, imgs_hr = imgs
+        self.imgs_lr = loader.scale_lr_imgs(imgs_lr.astype(np.float32))
+        self.imgs_hr = loader.scale_hr_imgs(imgs_hr.astype(np.float32))
+        print(">> Fixed validation set of {} crops".format(len(self.imgs_hr)))
+
+    def load(self, path):
+        """Stored uint8 crops, None if missing or drawn with other settings"""
+        if not os.path.isfile(path):
+            return None
+        data = np.load(path)
+        if any(str(data[k]) != str(v) for k, v in self.meta.items()):
+            return None
+        return data['lr'], data['hr']
+
+    def save(self, path, imgs_lr, imgs_hr):
+        # Complete files only, readers never see a partly written set
+        try:
+            with open(path + '.tmp', 'wb') as f:
+                np.savez(f, lr=imgs_lr, hr=imgs_hr, **self.meta)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError) as e:
+            print(">> Could not write validation set: {}".format(e))
+
+    @staticmethod
+    def build(loader, count, seed=0):
+        """Draw count uint8 crops from images taken in a seeded random order, leaving the global numpy random state alone"""
+        rng = np.random.RandomState(seed)
+        loader_rng, loader.rng = loader.rng, rng
+        order = rng.permutation(loader.total_imgs)
+        crops_per_item = loader.crops_per_image * (loader.frames_per_video if loader.media_type == 'v' else 1)
+        per_batch = loader.batch_size if loader.shards is not None else int(math.ceil(loader.batch_size / float(crops_per_item)))
+        imgs_lr, imgs_hr, n, k = [], [], 0, 0
+        while n < count:
+            items = order[np.arange(k * per_batch, (k + 1) * per_batch) % len(order)]
+            lr, hr = loader.load_batch(items=items)
+            imgs_lr.append(lr)
+            imgs_hr.append(hr)
+            n += len(hr)
+            k += 1
+        loader.rng = loader_rng
+        return np.concatenate(imgs_lr)[:count], np.concatenate(imgs_hr)[:count]
+
+    def __len__(self):
+        return int(math.ceil(len(self.imgs_hr) / float(self.batch_size)))
+
+    def __getitem__(self, idx):
+        batch = slice(idx * self.batch_size, (idx + 1) * self.batch_size)
+        return self.imgs_lr[batch], self.imgs_hr[batch]
+
+
+class BackgroundValidator(object):
+    """
+    Evaluation of weight snapshots of a model on a thread with its own graph and
+    session, so that the training loop never waits for validation. A snapshot
+    submitted while another one is evaluated replaces the pending one, and the
+    training loop collects the losses with results().
+    """
+
+    def __init__(self, model, session, data, steps):
+        """
+        :param Model model: compiled copy of the model, built in the graph of session
+        :param tf.Session session: session of the validation, e.g. with fewer threads
+        :param Sequence data: validation batches
+        :param int steps: batches evaluated per snapshot
+        """
+        self.model = model
+        self.session = session
+        self.data = data
+        self.steps = steps
+        self._pending = None
+        self._results = []
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='validation')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, epoch, weights):
+        """Queue the weights (as given by Model.get_weights) of an iteration for evaluation"""
+        with self._cond:
+            self._pending = (epoch, weights)
+            self._cond.notify_all()
+
+    def results(self):
+        """(iteration, losses) of the snapshots evaluated since the last call"""
+        with self._cond:
+            results, self._results = self._results, []
+        return results
+
+    def close(self):
+        """Evaluate the pending snapshot and stop the thread"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        # Default graph and session are per thread
+        with self.session.graph.as_default(), self.session.as_default():
+            while True:
+                with self._cond:
+                    while self._pending is None and not self._closed:
+                        self._cond.wait()
+                    if self._pending is None:
+                        return
+                    (epoch, weights), self._pending = self._pending, None
+                try:
+                    self.model.set_weights(weights)
+                    losses = self.model.evaluate_generator(self.data, steps=self.steps, workers=0)
+                except Exception as e:
+                    print(">> Could not validate iteration {}: {}".format(epoch, e))
+                    continue
+                with self._cond:
+                    self._results.append((epoch, losses))
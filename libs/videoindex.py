@@ -0,0 +1,78 @@
+import os
+import json
+import subprocess
+import cv2
+
+
+INDEX_SUFFIX = '.index.json'
+
+
+def index_path(videopath):
+    return videopath + INDEX_SUFFIX
+
+
+def probe_keyframes(videopath):
+    """
+    List the video packets with ffprobe (demux only, no decode) and return
+    the frame count and the keyframe positions in presentation order.
+    Returns None if ffprobe is not available.
+    """
+    try:
+        out = subprocess.check_output(
+            ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+             '-show_entries', 'packet=pts,flags', '-of', 'csv=p=0', videopath],
+            stderr=subprocess.STDOUT
+        ).decode()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    packets = []
+    for i, line in enumerate(out.split()):
+        pts, _, flags = line.partition(',')
+        packets.append((int(pts) if pts.lstrip('-').isdigit() else i, 'K' in flags))
+    packets.sort(key=lambda p: p[0])
+    return len(packets), [i for i, (_, key) in enumerate(packets) if key]
+
+
+def build_video_index(videopath):
+    """Read frame count, fps, resolution and keyframe positions of a video"""
+    cap = cv2.VideoCapture(videopath)
+    if not cap.isOpened():
+        raise IOError("Error to open video: {}".format(videopath))
+    index = {
+        'frames': int(cap.get(cv2.CAP_PROP_FRAME_COUNT)),
+        'fps': cap.get(cv2.CAP_PROP_FPS),
+        'width': int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+        'height': int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+        'keyframes': []
+    }
+    cap.release()
+    probe = probe_keyframes(videopath)
+    if probe is not None:
+        index['frames'], index['keyframes'] = probe
+    return index
+
+
+def load_video_index(videopath):
+    """
+    Load the sidecar index of a video, building it once if it is missing
+    or was built for a different file (mtime or size changed).
+    """
+    stat = os.stat(videopath)
+    path = index_path(videopath)
+    if os.path.isfile(path):
+        try:
+            with open(path) as f:
+                index = json.load(f)
+            if index['size'] == stat.st_size and index['mtime'] == stat.st_mtime:
+                return index
+        except (ValueError, KeyError):
+            pass
+    index = build_video_index(videopath)
+    index['size'] = stat.st_size
+    index['mtime'] = stat.st_mtime
+    try:
+        with open(path, 'w') as f:
+            json.dump(index, f)
+    except (IOError, OSError) as e:
+        print(">> Could not write video index: {}".format(e))
+    return index
@@ -0,0 +1,51 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'libs'))
+import pytest
+
+pytest.importorskip('keras')
+import numpy as np
+from keras import backend as K
+from keras.applications.vgg19 import VGG19
+import losses
+from srgan import SRGAN
+
+
+def untrained_vgg19(include_top=False, weights=None, input_shape=None):
+    """VGG19 without the ImageNet weights, which would be downloaded"""
+    return VGG19(include_top=include_top, weights=None, input_shape=input_shape)
+
+
+def test_fused_step_matches_unfused_losses(monkeypatch):
+    """On the same weights and batch, one fused step gives the losses of the discriminator and GAN train_on_batch"""
+    # Random VGG features truncated after the first block give a content loss as well
+    monkeypatch.setattr(losses, 'VGG19', untrained_vgg19)
+    gan = SRGAN(height_lr=12, width_lr=12, upscaling_factor=2, vgg_layer='block1_conv2')
+    fused = gan.build_fused_step()
+
+    rng = np.random.RandomState(0)
+    imgs_lr = rng.uniform(0, 1, (4, 12, 12, 3)).astype(np.float32)
+    imgs_hr = rng.uniform(-1, 1, (4, 24, 24, 3)).astype(np.float32)
+    generator_weights, discriminator_weights = gan.generator.get_weights(), gan.discriminator.get_weights()
+
+    outs = fused(imgs_lr, imgs_hr)
+
+    # Unfused path from the same weights, losses are computed before the updates
+    gan.generator.set_weights(generator_weights)
+    gan.discriminator.set_weights(discriminator_weights)
+    real = np.ones((4,) + gan.discriminator.output_shape[1:])
+    gan.discriminator.trainable = True
+    # The fused step feeds the discriminator the generator output of its training forward
+    generate = K.function([gan.generator.input, K.learning_phase()], [gan.generator.output])
+    generated_hr = generate([imgs_lr, 1])[0]
+    discriminator_loss = gan.discriminator.train_on_batch(
+        np.concatenate([imgs_hr, generated_hr]), np.concatenate([real, np.zeros_like(real)])
+    )
+    gan.discriminator.trainable = False
+    gan.generator.set_weights(generator_weights)
+    gan_loss = gan.srgan.train_on_batch(imgs_lr, [imgs_hr, real])
+
+    # Discriminator loss and accuracy
+    np.testing.assert_allclose(outs[:2], discriminator_loss, rtol=1e-4, atol=1e-5)
+    # Content loss, the generator runs once on the same batch
+    np.testing.assert_allclose(outs[3], gan_loss[1], rtol=1e-4, atol=1e-5)
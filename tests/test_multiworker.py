@@ -0,0 +1,78 @@
+import os
+import sys
+import json
+import socket
+import subprocess
+import pytest
+
+pytest.importorskip('tensorflow')
+pytest.importorskip('keras')
+import numpy as np
+
+LIBS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'libs')
+
+# One worker of the cluster: different initial weights and data on each worker,
+# and only the chief stops after the first epoch and lowers the learning rate
+WORKER = """
+import sys
+sys.path.append({libs!r})
+import numpy as np
+from keras import backend as K
+from keras.models import Sequential
+from keras.layers import Dense
+from keras.optimizers import SGD
+from keras.callbacks import LambdaCallback
+from distributed import MultiWorker, ChiefSync
+
+cluster = MultiWorker.from_env()
+cluster.start()
+np.random.seed(cluster.task_index)
+model = Sequential([Dense(4, input_shape=(3,), activation='tanh'), Dense(1)])
+model.compile(loss='mse', optimizer=cluster.all_reduce_gradients(SGD(lr=0.1)))
+
+def chief_decisions(epoch, logs):
+    if cluster.is_chief:
+        K.set_value(model.optimizer.lr, 0.01)
+        model.stop_training = True
+
+x, y = np.random.uniform(-1, 1, (8, 3)), np.random.uniform(-1, 1, (8, 1))
+history = model.fit(x, y, batch_size=4, epochs=3, shuffle=False, verbose=0, callbacks=[
+    LambdaCallback(on_epoch_end=chief_decisions), ChiefSync(cluster, model, steps_per_epoch=2)
+])
+np.savez({output!r}, *model.get_weights(), lr=K.get_value(model.optimizer.lr), epochs=len(history.epoch))
+"""
+
+
+def free_ports(n):
+    sockets = [socket.socket() for _ in range(n)]
+    for s in sockets:
+        s.bind(('localhost', 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def test_workers_share_weights_and_chief_decisions(tmpdir):
+    """Two local CPU workers end with the same weights, learning rate and number of epochs as the chief"""
+    cluster = {'worker': ['localhost:{}'.format(p) for p in free_ports(2)]}
+    outputs = [str(tmpdir.join('worker_{}.npz'.format(i))) for i in range(2)]
+    workers = []
+    for i, output in enumerate(outputs):
+        env = dict(os.environ, CUDA_VISIBLE_DEVICES='', TF_CONFIG=json.dumps({'cluster': cluster, 'task': {'type': 'worker', 'index': i}}))
+        workers.append(subprocess.Popen([sys.executable, '-c', WORKER.format(libs=LIBS, output=output)], env=env))
+    try:
+        for worker in workers:
+            assert worker.wait(timeout=300) == 0
+    finally:
+        for worker in workers:
+            if worker.poll() is None:
+                worker.kill()
+
+    chief, other = [np.load(output) for output in outputs]
+    weights = sorted(k for k in chief.files if k.startswith('arr_'))
+    assert weights
+    for k in weights:
+        np.testing.assert_array_equal(chief[k], other[k])
+    np.testing.assert_allclose([chief['lr'], other['lr']], 0.01)
+    assert chief['epochs'] == other['epochs'] == 1
@@ -0,0 +1,42 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'libs'))
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('PIL')
+from PIL import Image
+from textureindex import TextureIndex
+
+
+def high_contrast_image(path, size=256):
+    """Flat grey image with a black and white checkerboard in its bottom right quarter"""
+    img = np.full((size, size), 128, dtype=np.uint8)
+    y, x = np.mgrid[:size // 2, :size // 2]
+    img[size // 2:, size // 2:] = np.where((y // 2 + x // 2) % 2, 255, 0)
+    Image.fromarray(img).save(path)
+
+
+def test_high_contrast_scores_are_finite(tmpdir):
+    path = str(tmpdir.join('checker.png'))
+    high_contrast_image(path)
+    index = TextureIndex(str(tmpdir), [path], processes=1)
+    grid, _ = index.grid(path)
+    assert np.isfinite(grid).all()
+    # Beyond the float16 range
+    assert grid.max() > 65504
+
+    # Reloaded from the stored index
+    grid, _ = TextureIndex(str(tmpdir), [path], processes=1).grid(path)
+    assert np.isfinite(grid).all() and grid.max() > 65504
+
+
+def test_positions_follow_texture(tmpdir):
+    path = str(tmpdir.join('checker.png'))
+    high_contrast_image(path)
+    index = TextureIndex(str(tmpdir), [path], processes=1)
+    np.random.seed(0)
+    positions = np.array([index.position(path, 256, 256, 64, 64, floor=0.) for _ in range(200)])
+    # Crops on the checkerboard quarter (or its edge with the flat area), not uniform
+    assert (positions >= 64).all()
+    assert np.mean(positions >= 96) > 0.9
@@ -4,7 +4,7 @@
 
 import os
 import sys
-os.environ['CUDA_VISIBLE_DEVICES']='0' #Set a single gpu
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '0') #Set a single gpu, unless set (e.g. empty for CPU workers)
 #stderr = sys.stderr
 #sys.stderr = open(os.devnull, 'w')
 sys.path.append('libs/')  
@@ -15,6 +15,9 @@ import matplotlib.pyplot as plt
 from argparse import ArgumentParser
 from PIL import Image
 from srgan import SRGAN
+from sampler import ShardedSampler
+from distributed import MultiWorker
+from precision import supported_precisions
 from util import plot_test_images, DataLoader
 from keras import backend as K
 
@@ -29,6 +32,12 @@ python3 train.py --train ../../data/train_large/ --validation ../data/val_large/
 
 # Train the 8X SRGAN
 python3 train.py --train ../../data/train_large/ --validation ../data/val_large/ --test ../data/benchmarks/Set5/  --log_test_path ./test/ --scale 8 --scaleFrom 4 --stage all
+
+# Data-parallel generator pretraining over two local CPU worker processes
+for i in 0 1; do
+    CUDA_VISIBLE_DEVICES= TF_CONFIG='{"cluster": {"worker": ["localhost:12345", "localhost:12346"]}, "task": {"type": "worker", "index": '$i'}}' \
+    python3 train.py --train ../../data/train_large/ --validation ../data/val_large/ --scale 2 --stage mse --multi_worker --fixed_validation 512 &
+done; wait
 """
 
 def parse_args():
@@ -112,6 +121,12 @@ def parse_args():
         type=int, default=1000,
         help='Max queue size to workers'
     )
+
+    parser.add_argument(
+        '-mqm', '--max_queue_mb',
+        type=int, default=1024,
+        help='Memory budget in MB of the batches prefetched by the workers, limiting max_queue_size. 0 for no limit'
+    )
         
     parser.add_argument(
         '-bs', '--batch_size',
@@ -133,8 +148,8 @@ def parse_args():
 
     parser.add_argument(
         '-lwf', '--log_weight_frequency',
-        type=int, default=1,
-        help='Where to output weights during training'
+        type=int, default=1000,
+        help='Iterations between two checkpoints of the GAN stages, each copying and writing the full training state'
     )
 
     parser.add_argument(
@@ -176,7 +191,7 @@ def parse_args():
     parser.add_argument(
         '-c', '--channels',
         type=int, default=3,
-        help='channels of images'
+        help='channels of images, 1 with the YCbCr colorspace trains on the luma (Y) only'
     )
 
     parser.add_argument(
@@ -188,7 +203,158 @@ def parse_args():
     parser.add_argument(
         '-mt', '--media_type',
         type=str, default='i',
-        help='Type of media i to image or v to video'
+        help='Type of media i to image, v to video, p to patch shards (see build_patches.py) or t to tar shards (see build_tar_shards.py)'
+    )
+
+    parser.add_argument(
+        '-kfo', '--keyframes_only',
+        action='store_true',
+        help='In video mode, sample only keyframes, which are cheaper to seek'
+    )
+
+    parser.add_argument(
+        '-fpv', '--frames_per_video',
+        type=int, default=1,
+        help='In video mode, frames read from each video in one forward pass (each gives crops_per_image crops)'
+    )
+
+    parser.add_argument(
+        '-bd', '--batch_degradation',
+        action='store_true',
+        help='Workers return only HR crops, blurred, resized and augmented in batch with TF ops'
+    )
+
+    parser.add_argument(
+        '-dec', '--decode',
+        type=str, default='full',
+        help='JPEG decoding of training crops: full image, only the region of the crops (needs PyTurboJPEG) or reduced resolution draft',
+        choices=['full', 'region', 'draft']
+    )
+
+    parser.add_argument(
+        '-shm', '--shared_memory',
+        action='store_true',
+        help='Workers send uint8 batches through shared-memory slots instead of pickling float64 arrays'
+    )
+
+    parser.add_argument(
+        '-tfd', '--tf_data',
+        action='store_true',
+        help='Build training batches with a tf.data graph instead of enqueuer workers (image folders only)'
+    )
+
+    parser.add_argument(
+        '-rm', '--refresh_manifest',
+        action='store_true',
+        help='Check the size and mtime of every dataset file, to pick up files overwritten in place (new and removed files are picked up from the directory mtimes)'
+    )
+
+    parser.add_argument(
+        '-lt', '--loader_telemetry',
+        action='store_true',
+        help='Log loader stage times and enqueuer queue occupancy to tensorboard'
+    )
+
+    parser.add_argument(
+        '-icm', '--image_cache_mb',
+        type=int, default=0,
+        help='Memory budget in MB of decoded training images shared by the loader workers (image folders), 0 to disable'
+    )
+
+    parser.add_argument(
+        '-tf', '--texture_floor',
+        type=float, default=None,
+        help='Draw image crops from textured areas using an index stored with the dataset, with this share of uniform positions between 0 and 1 (e.g. 0.2). Disabled if not set'
+    )
+
+    parser.add_argument(
+        '-fv', '--fixed_validation',
+        type=int, default=0,
+        help='Number of validation crops drawn once with --validation_seed, stored with the validation data and kept in memory. 0 to draw new crops at each validation'
+    )
+
+    parser.add_argument(
+        '-vs', '--validation_seed',
+        type=int, default=0,
+        help='Seed of the fixed validation crops'
+    )
+
+    parser.add_argument(
+        '-fs', '--fused_step',
+        action='store_true',
+        help='In the SRGAN stage, update the discriminator and the generator from a single generator forward per iteration, in one graph call'
+    )
+
+    parser.add_argument(
+        '-vgg', '--vgg_layer',
+        type=str, default='block5_conv4',
+        help='VGG19 layer of the content loss features, e.g. block2_conv2 or block3_conv4 to truncate the network'
+    )
+
+    parser.add_argument(
+        '-vfc', '--vgg_feature_cache',
+        action='store_true',
+        help='With patch shards, read the VGG features of the HR patches from the cache built by build_features.py'
+    )
+
+    parser.add_argument(
+        '-pr', '--precision',
+        type=str, default='float32', choices=supported_precisions(),
+        help='float32, or mixed_bfloat16 for bfloat16 compute with float32 weights on CPUs supporting it, with TensorFlow builds having the oneDNN bfloat16 rewrite (see benchmark_precision.py)'
+    )
+
+    parser.add_argument(
+        '-as', '--accumulation_steps',
+        type=int, default=1,
+        help='Micro-batches of --batch_size whose gradients are averaged into each update, for an effective batch of batch_size x accumulation_steps. Batch normalization still uses the statistics of each micro-batch, and epochs / iterations count micro-batches'
+    )
+
+    parser.add_argument(
+        '-mw', '--multi_worker',
+        action='store_true',
+        help='Data-parallel training over the workers of the cluster in the TF_CONFIG environment variable. Each worker trains on its own shard of the data (seeded by --data_seed, 0 if not set), gradients are averaged over the workers and only worker 0 saves weights, samples and logs'
+    )
+
+    parser.add_argument(
+        '-r', '--resume',
+        action='store_true',
+        help='Resume the GAN stages from their last checkpoint: weights, optimizer states, iteration and data position'
+    )
+
+    parser.add_argument(
+        '-ck', '--checkpoints_to_keep',
+        type=int, default=3,
+        help='Most recent checkpoints of the GAN stages kept, besides the one with the best validation PSNR'
+    )
+
+    parser.add_argument(
+        '-vt', '--validation_threads',
+        type=int, default=2,
+        help='CPU threads validating snapshots of the generator weights in the background during the GAN stages, 0 to validate in the training loop'
+    )
+
+    parser.add_argument(
+        '-ds', '--data_seed',
+        type=int, default=None,
+        help='Seed for a deterministic and resumable order of the training data'
+    )
+
+    parser.add_argument(
+        '-ns', '--num_shards',
+        type=int, default=1,
+        help='Number of processes / nodes splitting the training data (needs --data_seed)'
+    )
+
+    parser.add_argument(
+        '-si', '--shard_index',
+        type=int, default=0,
+        help='Shard of the training data used by this process (needs --data_seed)'
+    )
+
+    parser.add_argument(
+        '-rd', '--resume_data',
+        action='store_true',
+        help='Resume the data order from the position saved with the weights'
     )
 
     parser.add_argument(
@@ -241,6 +407,22 @@ def gan_freeze_layers(args, gan):
     # Compile generator with frozen layers
     gan.compile_generator(gan.generator)
 
+def data_sampler(args, modelname, cluster=None):
+    '''Sampler of the training data order, resumed from the saved position if asked'''
+    if args.data_seed is None and cluster is None:
+        return None
+    path = os.path.join(args.weight_path, modelname+'_sampler.json')
+    if args.resume_data and os.path.isfile(path):
+        print(">> Resuming data order from", path)
+        sampler = ShardedSampler.load(path)
+        # The chief saves the position, all the workers are at the same step of their shard
+        if cluster is not None:
+            sampler = ShardedSampler(cluster.num_workers, cluster.task_index, sampler.seed, sampler.step)
+        return sampler
+    if cluster is not None:
+        return ShardedSampler(cluster.num_workers, cluster.task_index, args.data_seed or 0)
+    return ShardedSampler(args.num_shards, args.shard_index, args.data_seed)
+
 def train_generator(args, gan, common, epochs=None):
     '''Just a convenience function for training the GAN'''
     print("TRAINING GENERATOR ONLY WITH MSE LOSS")
@@ -248,11 +430,12 @@ def train_generator(args, gan, common, epochs=None):
         epochs=epochs,
         modelname='SRResNet'+args.modelname,        
         steps_per_epoch=args.steps_per_epoch,                
+        sampler=data_sampler(args, 'SRResNet'+args.modelname, gan.cluster),
         **common
     )
 
 
-def train_gan(args, gan, common, epochs=None):
+def train_gan(args, gan, common, epochs=None, stage='gan'):
     '''Just a convenience function for training the GAN'''
     
     gan.train_srgan(
@@ -261,6 +444,12 @@ def train_gan(args, gan, common, epochs=None):
         log_weight_frequency=args.log_weight_frequency,
         log_test_frequency=args.log_test_frequency,
         first_epoch=args.first_epoch,
+        sampler=data_sampler(args, 'SRGAN'+args.modelname, gan.cluster),
+        # Each stage resumes from its own checkpoints
+        checkpoint_path=os.path.join(args.weight_path, 'SRGAN{}_{}_checkpoints'.format(args.modelname, stage)),
+        checkpoints_to_keep=args.checkpoints_to_keep,
+        resume=args.resume,
+        validation_threads=args.validation_threads,
         **common
     )
 
@@ -285,9 +474,27 @@ if __name__ == '__main__':
         "log_weight_path": args.weight_path, 
         "log_tensorboard_path": args.log_path,        
         "log_test_path": args.log_test_path,        
-        "media_type": args.media_type
+        "media_type": args.media_type,
+        "keyframes_only": args.keyframes_only,
+        "frames_per_video": args.frames_per_video,
+        "batch_degradation": args.batch_degradation,
+        "decode": args.decode,
+        "shared_memory": args.shared_memory,
+        "tf_data": args.tf_data,
+        "refresh_manifest": args.refresh_manifest,
+        "loader_telemetry": args.loader_telemetry,
+        "image_cache_mb": args.image_cache_mb,
+        "texture_floor": args.texture_floor,
+        "max_queue_bytes": args.max_queue_mb << 20 if args.max_queue_mb else None,
+        "fixed_validation": args.fixed_validation,
+        "validation_seed": args.validation_seed,
+        "fused_step": args.fused_step,
+        "vgg_feature_cache": args.vgg_feature_cache
     }
 
+    # Cluster of the data-parallel workers
+    cluster = MultiWorker.from_env() if args.multi_worker else None
+
     # Specific of the model
     args_model = {
         "height_lr": args.height_lr, 
@@ -295,6 +502,10 @@ if __name__ == '__main__':
         "channels": args.channels,
         "upscaling_factor": args.scale, 
         "colorspace": args.colorspace,        
+        "vgg_layer": args.vgg_layer,
+        "precision": args.precision,
+        "accumulation_steps": args.accumulation_steps,
+        "cluster": cluster
     }
 
     # Generator weight paths
@@ -353,4 +564,4 @@ if __name__ == '__main__':
         )
         gan.load_weights(srrgan_G_path, srrgan_D_path)
         print("FINE TUNE GAN WITH LOW LEARNING RATE")
-        train_gan(args, gan, args_train, epochs=args.epochs//10 if args.epochs == int(1e6) else args.epochs)
\ No newline at end of file
+        train_gan(args, gan, args_train, epochs=args.epochs//10 if args.epochs == int(1e6) else args.epochs, stage='gan-finetune')
\ No newline at end of file